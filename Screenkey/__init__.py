@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import os
+import sys
 import gettext
 gettext.install('screenkey')
 _ = gettext.gettext
@@ -35,3 +37,31 @@ MODS_MODES = {
     'emacs': _('Emacs'),
     'mac': _('Mac'),
 }
+
+LISTENER_MODES = {
+    'thread': _('Thread'),
+    'glib': _('Main loop'),
+    'process': _('Separate process'),
+}
+
+CAPTURE_BACKENDS = {
+    'auto': _('Automatic'),
+    'record': _('XRecord'),
+    'xi2': _('XInput2 raw events'),
+    'evdev': _('Kernel input devices'),
+}
+
+TRANSLATORS = {
+    'xim': _('X input method'),
+    'xkb': _('xkbcommon'),
+}
+
+
+def listen(*args, **kwargs):
+    # asyncio event source, see aiolistener.listen; the listener modules use
+    # top-level imports, hence the same path hack as the main script
+    path = os.path.dirname(os.path.realpath(__file__))
+    if path not in sys.path:
+        sys.path.append(path)
+    from aiolistener import listen
+    return listen(*args, **kwargs)
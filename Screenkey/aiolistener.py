@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# asyncio front-end for InputListener: the X connections are watched with
+# loop.add_reader on the running event loop, without any extra thread, and
+# events are consumed with:
+#
+#   async for event in listen():
+#       ...
+#
+# Only GLib (not GTK) is pulled in by the listener, so this is suitable for
+# headless services.
+
+from inputlistener import MainLoopInputListener, InputType, QueuePolicy
+
+import asyncio
+
+
+class AsyncInputListener(MainLoopInputListener):
+    def __init__(self, loop, *args, **kwargs):
+        super().__init__(None, *args, **kwargs)
+        self.loop = loop
+        self.ready = asyncio.Event()
+        self._fds = []
+
+
+    def _watch(self, fds):
+        for fd in fds:
+            self.loop.add_reader(fd, self._dispatch, fd)
+        self._fds = fds
+
+
+    def _unwatch(self):
+        for fd in self._fds:
+            self.loop.remove_reader(fd)
+        self._fds = []
+
+
+    def _event_callback(self):
+        # events stay in the (bounded) queue until the consumer takes them:
+        # unlike callbacks, it cannot run before the dispatch returns, so
+        # queue_size also bounds the events read in one go
+        if self.queue.events:
+            self.ready.set()
+        return False
+
+
+async def listen(input_types=InputType.keyboard, kbd_compose=True, kbd_translate=True,
+                 kbd_levels=True, queue_size=256, queue_policy=QueuePolicy.coalesce):
+    loop = asyncio.get_running_loop()
+    listener = AsyncInputListener(loop, input_types, kbd_compose, kbd_translate,
+                                  kbd_levels, queue_size=queue_size,
+                                  queue_policy=queue_policy)
+    listener.start()
+    try:
+        while True:
+            await listener.ready.wait()
+            listener.ready.clear()
+            for data in listener.queue.take():
+                yield data
+    finally:
+        # also reached on cancellation or aclose(): tear down the record
+        # context, the XIC and the replay window
+        listener.stop()
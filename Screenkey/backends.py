@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# Registry of capture backends. Every backend follows the InputListener
+# contract: it is constructed with (callback, input_types, kbd_compose,
+# kbd_translate, kbd_levels, batch=...), provides start(), stop(),
+# join(timeout), is_alive() and a "stats" dict, and calls back from the GLib
+# main loop with KeyData (or lists of KeyData when "batch" is set).
+# Backends able to switch translation on the fly also provide
+# reconfigure(kbd_translate, kbd_levels).
+#
+# Backends are registered by name along with their capabilities and an
+# availability check used for auto-detection. The remaining keyword options
+# (listener_mode, translator, devices) are interpreted by each factory and
+# ignored when not applicable.
+
+from inputlistener import InputListener, GLibInputListener, InputType
+from processlistener import ProcessInputListener
+from evdevlistener import EvdevInputListener, INPUT_DIR
+import xlib
+import xkb
+
+from collections import namedtuple, OrderedDict
+import os
+
+
+class Capability:
+    translates = 'translates'   # keysyms/strings follow the active layout
+    composes   = 'composes'     # dead keys and compose sequences are resolved
+    device_ids = 'device_ids'   # input can be restricted to some devices
+    repeats    = 'repeats'      # auto-repeated keys are reported
+
+
+Backend = namedtuple('Backend', ['name', 'factory', 'capabilities', 'available'])
+
+BACKENDS = OrderedDict()
+
+
+def register(name, factory, capabilities, available):
+    BACKENDS[name] = Backend(name, factory, frozenset(capabilities), available)
+
+
+def get(name):
+    if name == 'auto':
+        return detect()
+    backend = BACKENDS.get(name)
+    if backend is None:
+        raise ValueError("unknown capture backend: {}".format(name))
+    return backend
+
+
+def detect():
+    # Registration order, except that X11 capture only sees X clients under
+    # Wayland: prefer the kernel devices there when readable
+    order = list(BACKENDS.values())
+    if os.environ.get('WAYLAND_DISPLAY'):
+        order.sort(key=lambda backend: backend.name != 'evdev')
+    for backend in order:
+        if backend.available():
+            return backend
+    raise Exception("no usable capture backend")
+
+
+def create(name, callback, input_types=InputType.keyboard, kbd_compose=True,
+           kbd_translate=True, kbd_levels=True, batch=False, **options):
+    backend = get(name)
+    listener = backend.factory(callback, input_types, kbd_compose, kbd_translate,
+                               kbd_levels, batch, **options)
+    listener.backend = backend.name
+    return listener
+
+
+
+def x11_extension(name):
+    if not os.environ.get('DISPLAY'):
+        return False
+    dpy = xlib.XOpenDisplay(None)
+    if not dpy:
+        return False
+    opcode, event, error = xlib.c_int(), xlib.c_int(), xlib.c_int()
+    ret = xlib.XQueryExtension(dpy, name, xlib.byref(opcode),
+                               xlib.byref(event), xlib.byref(error))
+    xlib.XCloseDisplay(dpy)
+    return bool(ret)
+
+
+def x11_listener(capture):
+    def factory(callback, input_types, kbd_compose, kbd_translate, kbd_levels, batch,
+                listener_mode='thread', translator='xim', devices=None):
+        if listener_mode == 'glib':
+            listener = GLibInputListener
+        elif listener_mode == 'process':
+            listener = ProcessInputListener
+        else:
+            listener = InputListener
+        return listener(callback, input_types, kbd_compose, kbd_translate, kbd_levels,
+                        batch=batch, kbd_translator=translator, capture=capture,
+                        devices=devices)
+    return factory
+
+
+def evdev_listener(callback, input_types, kbd_compose, kbd_translate, kbd_levels, batch,
+                   devices=None, **options):
+    return EvdevInputListener(callback, input_types, kbd_compose, kbd_translate,
+                              kbd_levels, batch=batch, devices=devices)
+
+
+def evdev_available():
+    # the keymap is compiled locally
+    if xkb.libxkbcommon is None:
+        return False
+    try:
+        names = os.listdir(INPUT_DIR)
+    except OSError:
+        return False
+    return any(name.startswith('event') and os.access(os.path.join(INPUT_DIR, name), os.R_OK)
+               for name in names)
+
+
+register('record', x11_listener('record'),
+         [Capability.translates, Capability.composes, Capability.repeats],
+         lambda: x11_extension(b"RECORD"))
+register('xi2', x11_listener('xi2'),
+         [Capability.translates, Capability.composes, Capability.device_ids],
+         lambda: xlib.libXi is not None and x11_extension(b"XInputExtension"))
+register('evdev', evdev_listener,
+         [Capability.translates, Capability.composes, Capability.device_ids,
+          Capability.repeats],
+         evdev_available)
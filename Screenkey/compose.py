@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+# In-process Compose sequence engine. The same Compose tables used by libX11
+# ($XCOMPOSEFILE, ~/.XCompose or the locale default) are parsed once and
+# compiled into a trie of nested dicts keyed by keysym, whose leaves are the
+# resulting strings. The compiled trie is cached on disk and reused as long
+# as none of the source files changed. Dead keys and Multi_key sequences can
+# then be resolved from the keysym stream without an input method.
+
+import xlib
+from keysyms import keysym_to_unicode
+
+import hashlib
+import os
+import pickle
+import re
+
+
+COMPOSE_ROOT = '/usr/share/X11/locale'
+CACHE_VERSION = 1
+
+_INCLUDE_RE = re.compile(r'^\s*include\s+"((?:[^"\\]|\\.)*)"')
+_RULE_RE = re.compile(r'^\s*((?:<[^>]+>\s*)+):\s*(?:"((?:[^"\\]|\\.)*)")?\s*([^\s#]+)?')
+_KEY_RE = re.compile(r'<([^>]+)>')
+_ESCAPE_RE = re.compile(r'\\(?:([0-7]{1,3})|[xX]([0-9a-fA-F]{1,2})|(.))')
+
+
+class ComposeResult:
+    nothing   = 0   # not part of a sequence
+    composing = 1   # sequence in progress
+    composed  = 2   # sequence completed
+    cancelled = 3   # sequence aborted by an unexpected key
+
+
+def is_modifier(keysym):
+    # same ranges as IsModifierKey() in Xutil.h
+    return (0xffe1 <= keysym <= 0xffee or 0xfe01 <= keysym <= 0xfe13
+            or keysym in [0xff7e, 0xff7f])
+
+
+def _unescape(string):
+    def repl(m):
+        if m.group(1):
+            return chr(int(m.group(1), 8))
+        if m.group(2):
+            return chr(int(m.group(2), 16))
+        return m.group(3)
+    return _ESCAPE_RE.sub(repl, string)
+
+
+def _locale_name():
+    for var in ['LC_ALL', 'LC_CTYPE', 'LANG']:
+        value = os.environ.get(var)
+        if value:
+            break
+    else:
+        value = 'C'
+    name, _, codeset = value.partition('@')[0].partition('.')
+    if codeset.lower().replace('-', '') == 'utf8':
+        codeset = 'UTF-8'
+    return name + '.' + codeset if codeset else name
+
+
+def locale_compose_file(root=COMPOSE_ROOT):
+    name = _locale_name()
+    try:
+        with open(os.path.join(root, 'compose.dir'), encoding='utf-8') as fd:
+            for line in fd:
+                parts = line.split()
+                if len(parts) == 2 and not line.startswith('#') \
+                   and parts[1] == name:
+                    return os.path.join(root, parts[0].rstrip(':'))
+    except OSError:
+        pass
+    # unknown locale: same fallback as libX11 for UTF-8
+    return os.path.join(root, 'en_US.UTF-8', 'Compose')
+
+
+def compose_file():
+    path = os.environ.get('XCOMPOSEFILE')
+    if path:
+        return path
+    path = os.path.expanduser('~/.XCompose')
+    if os.path.exists(path):
+        return path
+    return locale_compose_file()
+
+
+def _expand(path):
+    # substitutions supported by libX11 in include directives
+    path = path.replace('%H', os.path.expanduser('~'))
+    path = path.replace('%S', COMPOSE_ROOT)
+    if '%L' in path:
+        path = path.replace('%L', locale_compose_file())
+    return path
+
+
+class ComposeParser():
+    def __init__(self):
+        self.trie = {}
+        self.files = []
+        self._names = {}
+
+
+    def keysym(self, name):
+        keysym = self._names.get(name)
+        if keysym is None:
+            keysym = xlib.XStringToKeysym(name.encode())
+            self._names[name] = keysym
+        return keysym
+
+
+    def add(self, sequence, string):
+        node = self.trie
+        for keysym in sequence[:-1]:
+            nxt = node.get(keysym)
+            if not isinstance(nxt, dict):
+                # later rules override shorter ones, as in libX11
+                nxt = node[keysym] = {}
+            node = nxt
+        node[sequence[-1]] = string
+
+
+    def parse(self, path, depth=0):
+        if depth > 8 or path in (f for f, _ in self.files):
+            return
+        try:
+            with open(path, encoding='utf-8', errors='replace') as fd:
+                self.files.append((path, os.fstat(fd.fileno()).st_mtime_ns))
+                lines = fd.readlines()
+        except OSError:
+            return
+
+        for line in lines:
+            m = _INCLUDE_RE.match(line)
+            if m:
+                self.parse(_expand(_unescape(m.group(1))), depth + 1)
+                continue
+            m = _RULE_RE.match(line)
+            if m is None:
+                continue
+            sequence = [self.keysym(name) for name in _KEY_RE.findall(m.group(1))]
+            if not all(sequence):
+                continue
+            if m.group(2) is not None:
+                string = _unescape(m.group(2))
+            elif m.group(3):
+                keysym = self.keysym(m.group(3))
+                string = keysym and keysym_to_unicode(keysym)
+            else:
+                string = None
+            if string:
+                self.add(sequence, string)
+
+
+def _cache_path(path):
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+    return os.path.join(cache, 'screenkey', 'compose-' + digest + '.pickle')
+
+
+def _cache_load(cache):
+    try:
+        with open(cache, 'rb') as fd:
+            version, files, trie = pickle.load(fd)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+    if version != CACHE_VERSION:
+        return None
+    for path, mtime in files:
+        try:
+            if os.stat(path).st_mtime_ns != mtime:
+                return None
+        except OSError:
+            return None
+    return trie
+
+
+def _cache_save(cache, files, trie):
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        tmp = cache + '.' + str(os.getpid())
+        with open(tmp, 'wb') as fd:
+            pickle.dump((CACHE_VERSION, files, trie), fd, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache)
+    except OSError:
+        pass
+
+
+def load_table(path=None, cache=True):
+    if path is None:
+        path = compose_file()
+    cache_path = _cache_path(path) if cache else None
+    if cache_path:
+        trie = _cache_load(cache_path)
+        if trie is not None:
+            return trie
+    parser = ComposeParser()
+    parser.parse(path)
+    if cache_path:
+        _cache_save(cache_path, parser.files, parser.trie)
+    return parser.trie
+
+
+
+class Composer():
+    def __init__(self, table):
+        self.table = table
+        self.node = table
+        self.sequence = []
+
+
+    def reset(self):
+        self.node = self.table
+        self.sequence = []
+
+
+    def feed(self, keysym):
+        if is_modifier(keysym):
+            return ComposeResult.nothing, None
+        nxt = self.node.get(keysym)
+        if nxt is None:
+            if self.node is self.table:
+                return ComposeResult.nothing, None
+            self.reset()
+            return ComposeResult.cancelled, None
+        if isinstance(nxt, dict):
+            self.node = nxt
+            self.sequence.append(keysym)
+            return ComposeResult.composing, None
+        self.reset()
+        return ComposeResult.composed, nxt
+
+
+    def preedit(self):
+        # partial sequence as displayable text: dead keys show their
+        # combining character (on a space), anything else its own value
+        chars = []
+        for keysym in self.sequence:
+            if keysym == 0xff20:
+                chars.append('⎄')
+                continue
+            string = keysym_to_unicode(keysym)
+            if string is None:
+                continue
+            if 0xfe50 <= keysym <= 0xfe8f:
+                string = ' ' + string
+            chars.append(string)
+        return ''.join(chars)
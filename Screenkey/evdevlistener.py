@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+# Capture backend reading the kernel input devices directly, for sessions
+# where the X server cannot be recorded (Wayland compositors, kiosks). Key
+# events are read from /dev/input/event* as packed input_event structs, and
+# translated through a keymap compiled with libxkbcommon, whose state is
+# tracked from the key transitions themselves. Devices are added and removed
+# as they appear through inotify. Read access to the devices is required
+# (usually by being a member of the "input" group).
+#
+# Events are delivered as regular KeyData from the GLib main loop, so this
+# is a drop-in replacement for InputListener.
+
+from inputlistener import InputType, KeyData, EventDelivery, QueuePolicy, lookup_string
+import compose
+import xkb
+
+from gi.repository import GLib as glib
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+from struct import Struct
+
+
+INPUT_DIR = '/dev/input'
+
+# struct input_event
+INPUT_EVENT = Struct('@llHHi')
+INPUT_EVENT_BATCH = 64
+
+EV_SYN = 0x00
+EV_KEY = 0x01
+SYN_DROPPED = 3
+
+KEY_RELEASE = 0
+KEY_PRESS = 1
+KEY_REPEAT = 2
+
+KEY_ENTER = 28
+KEY_A = 30
+KEY_SPACE = 57
+KEY_MAX = 0x2ff
+
+# evdev codes are offset by 8 in xkb keycodes
+EVDEV_OFFSET = 8
+
+# struct inotify_event (followed by the name)
+INOTIFY_EVENT = Struct('@iIII')
+IN_ATTRIB = 0x00000004
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+libc.inotify_init1.argtypes = [ctypes.c_int]
+libc.inotify_init1.restype = ctypes.c_int
+libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+libc.inotify_add_watch.restype = ctypes.c_int
+
+# upper bound for the (keycode, state) translation cache
+LOOKUP_CACHE_SIZE = 4096
+
+
+def EVIOCGBIT(ev, length):
+    # _IOC(_IOC_READ, 'E', 0x20 + ev, length)
+    return (2 << 30) | (length << 16) | (ord('E') << 8) | (0x20 + ev)
+
+
+def is_keyboard(fd):
+    # anything with letters, space and enter: excludes power buttons, lid
+    # switches and media remotes which also report EV_KEY
+    bits = bytearray(KEY_MAX // 8 + 1)
+    try:
+        fcntl.ioctl(fd, EVIOCGBIT(EV_KEY, len(bits)), bits)
+    except OSError:
+        return False
+    return all(bits[key // 8] & (1 << (key % 8)) for key in [KEY_A, KEY_SPACE, KEY_ENTER])
+
+
+def inotify_watch(path, mask):
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0 or libc.inotify_add_watch(fd, path.encode(), mask) < 0:
+        err = ctypes.get_errno()
+        if fd >= 0:
+            os.close(fd)
+        raise OSError(err, os.strerror(err), path)
+    return fd
+
+
+def inotify_read(fd):
+    names = []
+    try:
+        while True:
+            data = os.read(fd, 4096)
+            if not data:
+                break
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0').decode()
+                offset += length
+                names.append((mask, name))
+    except BlockingIOError:
+        pass
+    return names
+
+
+
+class EvdevInputListener(EventDelivery):
+    # Only the keyboard is supported. The device ids given in "devices" are
+    # the event numbers (/dev/input/eventN).
+    _main_loop = True
+
+    def __init__(self, callback, input_types=InputType.keyboard, kbd_compose=True,
+                 kbd_translate=True, kbd_levels=True, batch=False, queue_size=256,
+                 queue_policy=QueuePolicy.coalesce, devices=None):
+        self._delivery_init(callback, batch, queue_size, queue_policy)
+        self.input_types = input_types
+        self.kbd_compose = kbd_compose
+        self.kbd_translate = kbd_translate
+        self.kbd_levels = kbd_levels
+        self.devices = set(devices) if devices else None
+        self.stats = {'batches': 0, 'events': 0, 'max_batch': 0, 'wakeups': 0,
+                      'dropped': 0, 'devices': 0}
+        self.stopped = True
+        self._devs = {}
+        self._inotify = None
+        self._inotify_source = None
+        self._lookup_cache = {}
+
+
+    def start(self):
+        self.stopped = False
+        self.keyboard = xkb.XkbKeyboard()
+        self.composer = None
+        if self.kbd_compose and self.kbd_translate:
+            self.composer = compose.Composer(compose.load_table())
+
+        # watch before scanning, so that no device can be missed
+        self._inotify = inotify_watch(INPUT_DIR, IN_CREATE | IN_ATTRIB | IN_DELETE)
+        self._inotify_source = glib.unix_fd_add_full(glib.PRIORITY_DEFAULT, self._inotify,
+                                                     glib.IOCondition.IN, self._hotplug)
+        for name in sorted(os.listdir(INPUT_DIR)):
+            self._device_add(name)
+
+
+    def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.queue.close()
+        for name in list(self._devs):
+            self._device_del(name)
+        if self._inotify_source is not None:
+            glib.source_remove(self._inotify_source)
+            self._inotify_source = None
+        if self._inotify is not None:
+            os.close(self._inotify)
+            self._inotify = None
+        self.keyboard.close()
+
+
+    def reconfigure(self, kbd_translate=None, kbd_levels=None):
+        if kbd_translate is not None:
+            self.kbd_translate = kbd_translate
+        if kbd_levels is not None:
+            self.kbd_levels = kbd_levels
+        if self.kbd_compose and self.kbd_translate and self.composer is None:
+            self.composer = compose.Composer(compose.load_table())
+
+
+    def join(self, timeout=None):
+        pass
+
+
+    def is_alive(self):
+        return not self.stopped
+
+
+    def _device_add(self, name):
+        if not name.startswith('event') or name in self._devs:
+            return
+        try:
+            num = int(name[5:])
+        except ValueError:
+            return
+        if self.devices is not None and num not in self.devices:
+            return
+        try:
+            fd = os.open(os.path.join(INPUT_DIR, name),
+                         os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+        except OSError:
+            # not (yet) readable: permissions are fixed up by udev later on,
+            # which is reported as IN_ATTRIB
+            return
+        if not is_keyboard(fd):
+            os.close(fd)
+            return
+        source = glib.unix_fd_add_full(glib.PRIORITY_DEFAULT, fd,
+                                       glib.IOCondition.IN | glib.IOCondition.HUP |
+                                       glib.IOCondition.ERR, self._device_ready, name)
+        self._devs[name] = (fd, source)
+        self.stats['devices'] = len(self._devs)
+
+
+    def _device_del(self, name, remove_source=True):
+        dev = self._devs.pop(name, None)
+        if dev is None:
+            return
+        fd, source = dev
+        if remove_source:
+            glib.source_remove(source)
+        os.close(fd)
+        self.stats['devices'] = len(self._devs)
+
+
+    def _hotplug(self, fd, condition):
+        for mask, name in inotify_read(fd):
+            if mask & IN_DELETE:
+                self._device_del(name)
+            elif mask & (IN_CREATE | IN_ATTRIB):
+                self._device_add(name)
+        return True
+
+
+    def _device_ready(self, fd, condition, name):
+        self.stats['wakeups'] += 1
+        alive = not (condition & (glib.IOCondition.HUP | glib.IOCondition.ERR))
+        count = 0
+        while alive:
+            try:
+                data = os.read(fd, INPUT_EVENT.size * INPUT_EVENT_BATCH)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno != errno.ENODEV:
+                    raise
+                alive = False
+                break
+            for _, _, ev_type, code, value in INPUT_EVENT.iter_unpack(data):
+                if ev_type == EV_KEY:
+                    self._key_event(code, value)
+                    count += 1
+                elif ev_type == EV_SYN and code == SYN_DROPPED:
+                    # the kernel buffer overflowed: held keys are unknown
+                    self.stats['dropped'] += 1
+                    self.keyboard.reset()
+                    self._lookup_cache.clear()
+
+        if count:
+            self.stats['batches'] += 1
+            self.stats['events'] += count
+            if count > self.stats['max_batch']:
+                self.stats['max_batch'] = count
+            self._event_callback()
+
+        if not alive:
+            # unplugged: returning False removes the source
+            self._device_del(name, remove_source=False)
+        return alive
+
+
+    def _lookup(self, keycode, state):
+        # the translation only depends on the effective state
+        key = (keycode, state)
+        ret = self._lookup_cache.get(key)
+        if ret is None:
+            if len(self._lookup_cache) >= LOOKUP_CACHE_SIZE:
+                self._lookup_cache.clear()
+            ret = self.keyboard.key_get(keycode)
+            self._lookup_cache[key] = ret
+        return ret
+
+
+    def _key_event(self, code, value):
+        keycode = code + EVDEV_OFFSET
+        kbd = self.keyboard
+        state = kbd.core_state()
+
+        data = KeyData()
+        data.filtered = False
+        data.pressed = (value != KEY_RELEASE)
+        data.repeated = (value == KEY_REPEAT)
+        data.mods_mask = state
+        if data.pressed and self.kbd_translate:
+            data.keysym, string = self._lookup(keycode, state)
+            data.string = lookup_string(data.keysym, string)
+            if self.composer is not None:
+                self._event_compose(self.composer, data)
+        elif self.kbd_levels:
+            data.keysym = self._lookup(keycode, state)[0]
+        else:
+            data.keysym = kbd.key_get_base(keycode)
+
+        # the state is updated after the lookup, as in core events
+        if value != KEY_REPEAT:
+            kbd.update(keycode, data.pressed)
+        self._event_processed(data)
+
+
+    def _event_wakeup(self):
+        # delivery happens at the end of _device_ready
+        pass
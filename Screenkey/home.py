@@ -2,7 +2,7 @@
 
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, Gdk
+from gi.repository import Gtk, Gdk, GLib
 from gi.repository import Pango
 
 import json
@@ -10,7 +10,7 @@ import cairo
 import subprocess
 from threading import Timer
 
-from labelmanager import LabelManager
+from labelmanager import LabelManager, STOP_TIMEOUT
 
 
 class Home(Gtk.Window):
@@ -24,7 +24,9 @@ class Home(Gtk.Window):
 
         self.timer_hide = None
         self.timer_min = None
+        self.timer_restart = None
         self.labelmngr = None
+        self.labelmngr_cnf = None
 
         self.width, self.height = self.get_size()
         self.set_active_monitor(self.cnf['screen'])
@@ -130,6 +132,11 @@ class Home(Gtk.Window):
 
 
     def on_label_change(self, markup):
+        if not markup and self.cnf['expire']:
+            # every key expired on its own
+            self.on_timeout_main()
+            return
+
         r, attr, text, *z = Pango.parse_markup(markup, -1, '\000')
         self.label.set_text(text)
         self.label.set_attributes(attr)
@@ -181,8 +188,15 @@ class Home(Gtk.Window):
             recent_thr = self.cnf['recent_thr'],
             compr_cnt  = self.cnf['compr_cnt'],
             ignore     = self.cnf['ignore'],
-            pango_ctx  = self.label.get_pango_context()
+            pango_ctx  = self.label.get_pango_context(),
+            listener_mode = self.cnf['listener'],
+            translator = self.cnf['translator'],
+            capture = self.cnf['capture'],
+            devices = self.cnf['devices'],
+            history = self.cnf['history'],
+            expire = self.cnf['timeout'] if self.cnf['expire'] else 0
         )
+        self.labelmngr_cnf = dict(self.cnf)
         self.labelmngr.start()
 
 
@@ -191,6 +205,25 @@ class Home(Gtk.Window):
             return
 
         if self.labelmngr:
-            self.labelmngr.stop()
+            changed = {k for k, v in self.cnf.items() if self.labelmngr_cnf.get(k) != v}
+            if changed == {'key_mode'}:
+                # the capture keeps running where possible
+                self.labelmngr.set_key_mode(self.cnf['key_mode'])
+                self.labelmngr_cnf = dict(self.cnf)
+                return
+
+        if self.labelmngr and not self.labelmngr.stop():
+            # the previous listener is still shutting down: retry later
+            # instead of running two captures at once
+            if self.timer_restart is None:
+                self.timer_restart = GLib.timeout_add(int(STOP_TIMEOUT * 1000),
+                                                      self.on_restart)
+            return
         self.logger.debug("Restart LabelManager")
         self.start_labelmanager()
+
+
+    def on_restart(self):
+        self.timer_restart = None
+        self.on_change_mode()
+        return False
@@ -32,7 +32,9 @@
 # 21/08/2015.
 
 import xlib
-import keysyms
+import xkb
+import compose
+from keysyms import keysym_to_unicode
 
 import sys
 if sys.version_info.major < 3:
@@ -41,10 +43,15 @@ else:
     import gi
     from gi.repository import GLib as glib
 
+import abc
+import os
 import threading
 import warnings
 import select
 
+from collections import deque, OrderedDict
+from collections.abc import Mapping
+
 
 # convenience wrappers
 def coalesce_ranges(ranges):
@@ -92,8 +99,8 @@ def record_enable(dpy, rec_ctx, callback):
         if data.client_swapped:
             warnings.warn("cannot handle swapped protocol data")
             return
-        ev = xlib.XWireToEvent(dpy, data.data)
-        callback(ev)
+        # a single reply can carry several wire events: hand them all over
+        callback(xlib.string_at(data.data, data.data_len * 4))
 
     def intercept_(_, data):
         intercept(data.contents)
@@ -104,6 +111,19 @@ def record_enable(dpy, rec_ctx, callback):
     return proc
 
 
+def xi2_select(dpy, win, events):
+    mask = (xlib.c_ubyte * xlib.XIMaskLen(xlib.XI_LASTEVENT))()
+    for ev in events:
+        xlib.XISetMask(mask, ev)
+    evmask = xlib.XIEventMask(xlib.XIAllMasterDevices, len(mask), mask)
+    xlib.XISelectEvents(dpy, win, xlib.byref(evmask), 1)
+
+
+def xkb_core_state(st):
+    # state field of the core events sent to XKB-aware clients
+    return xlib.XkbBuildCoreState(st.lookup_mods, st.group) | (st.ptr_buttons & 0x1f00)
+
+
 def create_replay_window(dpy):
     win_attr = xlib.XSetWindowAttributes()
     win_attr.override_redirect = True
@@ -115,31 +135,117 @@ def create_replay_window(dpy):
     return win
 
 
-def phantom_release(dpy, kev):
+def phantom_release(dpy, kev, peek):
     if not xlib.XPending(dpy):
         return False
-    ev = xlib.XEvent()
-    xlib.XPeekEvent(dpy, xlib.byref(ev))
-    return (ev.type == xlib.KeyPress and \
-            ev.xkey.state == kev.state and \
-            ev.xkey.keycode == kev.keycode and \
-            ev.xkey.time == kev.time)
-
-
-def keysym_to_unicode(keysym):
-    if 0x01000000 <= keysym <= 0x0110FFFF:
-        return unichr(keysym - 0x01000000)
-    keydata = keysyms.KEYSYMS.get(keysym)
-    if keydata is not None:
-        return keydata[0]
-    return None
-
+    xlib.XPeekEvent(dpy, peek.ref)
+    return (peek.ev.type == xlib.KeyPress and \
+            peek.xkey.state == kev.state and \
+            peek.xkey.keycode == kev.keycode and \
+            peek.xkey.time == kev.time)
+
+
+def keymap_table(dpy):
+    # flat keycode/group/level -> keysym table, see keymap_lookup
+    min_kc, max_kc = xlib.c_int(), xlib.c_int()
+    xlib.XDisplayKeycodes(dpy, xlib.byref(min_kc), xlib.byref(max_kc))
+    table = [xlib.NoSymbol] * (256 * KEYMAP_GROUPS * KEYMAP_LEVELS)
+    for keycode in range(min_kc.value, max_kc.value + 1):
+        for group in range(KEYMAP_GROUPS):
+            base = (keycode * KEYMAP_GROUPS + group) * KEYMAP_LEVELS
+            for level in range(KEYMAP_LEVELS):
+                table[base + level] = xlib.XkbKeycodeToKeysym(dpy, keycode, group, level)
+    return table
+
+
+def keymap_lookup(table, keycode, state, levels=True):
+    # the group comes from the XKB bits of the core state; the level is
+    # approximated from Shift/Mod5 (ISO_Level3), which covers common layouts
+    base = (keycode * KEYMAP_GROUPS + ((state >> 13) & 3)) * KEYMAP_LEVELS
+    if levels:
+        level = (state & xlib.ShiftMask) | ((state & xlib.Mod5Mask) >> 6)
+        keysym = table[base + level]
+        if keysym != xlib.NoSymbol:
+            return keysym
+    keysym = table[base]
+    if keysym == xlib.NoSymbol:
+        # groups with no symbols wrap to the first one
+        keysym = table[keycode * KEYMAP_GROUPS * KEYMAP_LEVELS]
+    return keysym
+
+
+def lookup_string(keysym, string):
+    # avoid ctrl sequences, just take the character value
+    if 32 <= keysym <= 126:
+        return chr(keysym)
+    return string
+
+
+def im_active():
+    # an input method server is configured through XMODIFIERS
+    modifiers = os.environ.get('XMODIFIERS', '')
+    return '@im=' in modifiers and '@im=none' not in modifiers.lower()
+
+
+
+class XEventBuffer():
+    # Preallocated XEvent along with the field views we need: accessing a
+    # ctypes sub-structure creates a new object each time, so keep them around
+    def __init__(self):
+        self.ev = xlib.XEvent()
+        self.ref = xlib.byref(self.ev)
+        self.xkey = self.ev.xkey
+        self.xkey_ref = xlib.byref(self.xkey)
+        self.xclient = self.ev.xclient
+        self.xclient_data = self.xclient.data
+        self.xmapping_ref = xlib.byref(self.ev.xmapping)
+        self.xcookie = self.ev.xcookie
+        self.xcookie_ref = xlib.byref(self.xcookie)
+        self.xkbstate = xlib.XkbStateNotifyEvent.from_buffer(self.ev)
+
+
+
+# modifier names exposed by KeyData.modifiers, with their state masks
+MODIFIER_MASKS = (
+    ('shift', xlib.ShiftMask),
+    ('caps_lock', xlib.LockMask),
+    ('ctrl', xlib.ControlMask),
+    ('alt', xlib.Mod1Mask),
+    ('num_lock', xlib.Mod2Mask),
+    ('hyper', xlib.Mod3Mask),
+    ('super', xlib.Mod4Mask),
+    ('alt_gr', xlib.Mod5Mask),
+)
+MODIFIER_MASK = dict(MODIFIER_MASKS)
+
+
+class Modifiers(Mapping):
+    # read-only name -> bool view over a modifier mask
+    __slots__ = ('mask',)
+
+    def __init__(self, mask):
+        self.mask = mask or 0
+
+    def __getitem__(self, name):
+        return bool(self.mask & MODIFIER_MASK[name])
+
+    def __iter__(self):
+        return (name for name, _ in MODIFIER_MASKS)
+
+    def __len__(self):
+        return len(MODIFIER_MASKS)
+
+    def __repr__(self):
+        return repr(dict(self))
 
 
 class KeyData():
+    __slots__ = ('pressed', 'filtered', 'repeated', 'string', 'keysym',
+                 'status', 'symbol', 'mods_mask', 'count', 'preedit', '_modifiers')
+
     def __init__(self, pressed=None, filtered=None, repeated=None,
                  string=None, keysym=None, status=None, symbol=None,
-                 mods_mask=None, modifiers=None):
+                 mods_mask=None, modifiers=None, count=1, preedit=None):
         self.pressed = pressed
         self.filtered = filtered
         self.repeated = repeated
@@ -147,8 +253,100 @@ class KeyData():
         self.keysym = keysym
         self.status = status
         self.symbol = symbol
+        if mods_mask is None and modifiers is not None:
+            mods_mask = 0
+            for name, value in modifiers.items():
+                if value: mods_mask |= MODIFIER_MASK[name]
         self.mods_mask = mods_mask
-        self.modifiers = modifiers
+        self.count = count
+        self.preedit = preedit
+        self._modifiers = None
+
+    @property
+    def modifiers(self):
+        # built on first access only: most events never look at it
+        if self._modifiers is None or self._modifiers.mask != self.mods_mask:
+            self._modifiers = Modifiers(self.mods_mask)
+        return self._modifiers
+
+
+class QueuePolicy:
+    block       = 'block'
+    drop_oldest = 'drop_oldest'
+    coalesce    = 'coalesce'
+
+
+class EventQueue():
+    # Bounded queue between the listener and its consumer. When full, the
+    # producer either waits (block) or the oldest event is discarded
+    # (drop_oldest). With coalesce, auto-repeats of the last queued repeat
+    # are merged by incrementing its count, dropping the oldest otherwise.
+    def __init__(self, size=256, policy=QueuePolicy.coalesce):
+        self.size = size
+        self.policy = policy
+        self.events = deque()
+        self.cond = threading.Condition()
+        self.armed = False
+        self.closed = False
+        self.dropped = 0
+        self.coalesced = 0
+        self.blocked = 0
+
+
+    def _coalesce(self, data):
+        if not data.repeated or not self.events:
+            return False
+        last = self.events[-1]
+        if not (last.repeated and last.pressed == data.pressed and \
+                last.keysym == data.keysym and last.mods_mask == data.mods_mask and \
+                last.filtered == data.filtered and last.string == data.string):
+            return False
+        last.count += data.count
+        self.coalesced += data.count
+        return True
+
+
+    def put(self, data):
+        # returns True when the consumer needs to be woken up
+        with self.cond:
+            if self.policy == QueuePolicy.coalesce and self._coalesce(data):
+                return False
+            if len(self.events) >= self.size:
+                if self.policy == QueuePolicy.block:
+                    self.blocked += 1
+                    while len(self.events) >= self.size and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        return False
+                else:
+                    self.events.popleft()
+                    self.dropped += 1
+            self.events.append(data)
+            if self.armed:
+                return False
+            self.armed = True
+            return True
+
+
+    def take(self):
+        with self.cond:
+            events = list(self.events)
+            self.events.clear()
+            self.armed = False
+            self.cond.notify_all()
+        return events
+
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+    @property
+    def stats(self):
+        return {'dropped': self.dropped, 'coalesced': self.coalesced,
+                'blocked': self.blocked}
 
 
 class InputType:
@@ -157,78 +355,218 @@ class InputType:
     movement = 0b100
     all      = 0b111
 
+# raw XInput2 events and the core events they stand for
+XI2_EVENTS = {
+    xlib.XI_RawKeyPress:      (InputType.keyboard, xlib.KeyPress),
+    xlib.XI_RawKeyRelease:    (InputType.keyboard, xlib.KeyRelease),
+    xlib.XI_RawButtonPress:   (InputType.button,   xlib.ButtonPress),
+    xlib.XI_RawButtonRelease: (InputType.button,   xlib.ButtonRelease),
+    xlib.XI_RawMotion:        (InputType.movement, xlib.MotionNotify),
+}
 
 
-class InputListener(threading.Thread):
-    def __init__(self, callback, input_types=InputType.all, kbd_compose=True, kbd_translate=True):
-        super().__init__()
+
+# number of input contexts kept for recently focused windows (at least 2)
+XIC_CACHE_SIZE = 16
+
+# FocusIn details for the window actually getting the focus
+FOCUS_DETAILS = frozenset([xlib.NotifyAncestor, xlib.NotifyInferior, xlib.NotifyNonlinear])
+
+# groups and shift levels kept in the keycode lookup table
+KEYMAP_GROUPS = 4
+KEYMAP_LEVELS = 4
+
+# upper bound for the keysym name cache (only a handful are used in practice)
+KEYSYM_CACHE_SIZE = 512
+
+
+class EventDelivery():
+    # KeyData finishing, composition and delivery shared by the listeners:
+    # processed events are queued, and handed to the callback from the main
+    # loop (in lists when "batch" is set). Listeners running on the main
+    # loop itself set _main_loop and deliver at the end of each dispatch.
+    _main_loop = False
+
+    def _delivery_init(self, callback, batch, queue_size, queue_policy):
+        if self._main_loop and queue_policy == QueuePolicy.block:
+            raise ValueError("cannot block the main loop on its own queue")
         self.callback = callback
+        self.batch = batch
+        self.queue = EventQueue(queue_size, queue_policy)
+        self._keysym_cache = {}
+
+
+    def _keysym_names(self, keysym):
+        names = self._keysym_cache.get(keysym)
+        if names is None:
+            if len(self._keysym_cache) >= KEYSYM_CACHE_SIZE:
+                self._keysym_cache.clear()
+            symbol = xlib.XKeysymToString(keysym)
+            if symbol is not None:
+                symbol = symbol.decode('ascii')
+            names = (symbol, keysym_to_unicode(keysym))
+            self._keysym_cache[keysym] = names
+        return names
+
+
+    def _event_compose(self, composer, data):
+        # resolve dead keys and compose sequences from the keysym stream
+        result, string = composer.feed(data.keysym)
+        if result == compose.ComposeResult.nothing:
+            return
+        if result == compose.ComposeResult.composed:
+            data.string = string
+        else:
+            # keys consumed by the sequence, like XFilterEvent would
+            data.filtered = True
+            data.string = None
+        self._event_queue(KeyData(preedit=composer.preedit()))
+
+
+    def _event_processed(self, data):
+        data.symbol, string = self._keysym_names(data.keysym)
+        if data.string is None:
+            data.string = string
+        self._event_queue(data)
+
+
+    def _event_queue(self, data):
+        if self._main_loop and len(self.queue.events) >= self.queue.size:
+            # the consumer runs on this same loop: hand over a full queue
+            # right away instead of dropping what it never had a chance to see
+            self._event_callback()
+        if self.queue.put(data):
+            self._event_wakeup()
+
+
+    def _event_wakeup(self):
+        glib.idle_add(self._event_callback)
+
+
+    def _event_callback(self):
+        events = self.queue.take()
+        if not events:
+            return False
+        if self.batch:
+            self.callback(events)
+        else:
+            for data in events:
+                self.callback(data)
+        return False
+
+
+
+class InputListener(threading.Thread, EventDelivery):
+    def __init__(self, callback, input_types=InputType.all, kbd_compose=True, kbd_translate=True,
+                 kbd_levels=True, batch=False, queue_size=256,
+                 queue_policy=QueuePolicy.coalesce, kbd_translator='xim',
+                 capture='record', devices=None):
+        super().__init__()
+        self._delivery_init(callback, batch, queue_size, queue_policy)
         self.input_types = input_types
         self.kbd_compose = kbd_compose
         self.kbd_translate = kbd_translate
+        self.kbd_levels = kbd_levels
+        self.kbd_translator = kbd_translator
+        self._kbd_xkb = None
+        self.capture = capture
+        self.devices = set(devices) if devices else None
         self.lock = threading.Lock()
         self.stopped = True
-
-
-    def _event_received(self, ev):
-        if xlib.KeyPress <= ev.type <= xlib.MotionNotify:
-            xlib.XSendEvent(self.replay_dpy, self.replay_win, False, 0, ev)
-        elif ev.type in [xlib.FocusIn, xlib.FocusOut]:
+        self.stats = {'batches': 0, 'events': 0, 'max_batch': 0, 'wakeups': 0,
+                      'xic_hits': 0, 'xic_misses': 0, 'xic_evictions': 0,
+                      'xic_resets_avoided': 0}
+        self._pending = []
+
+        # X resources, released by _teardown even after a failed _setup
+        self.replay_dpy = self.replay_win = None
+        self.capture_dpy = self.control_dpy = self.record_ctx = None
+        self._kbd_replay_xim = None
+        self._kbd_xics = OrderedDict()
+
+        # self-pipe used to wake up the event loop for commands (stop, flush
+        # and reconfigure), executed on the listener thread
+        self._commands = deque()
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in [self._wake_r, self._wake_w]:
+            os.set_blocking(fd, False)
+
+        # recorded events are kept as decoded wire tuples and only turned into
+        # XEvents when sent, using buffers owned by the listener thread
+        self._send_buf = XEventBuffer()
+        self._fwd_buf = XEventBuffer()
+        self._replay_buf = XEventBuffer()
+        self._peek_buf = XEventBuffer()
+
+
+    def _event_received(self, data):
+        # only queue here: events are sent in bulk by _event_flush once the
+        # current batch of replies has been processed
+        self._pending.extend(xlib.XWireEvents(data))
+
+
+    def _event_flush(self):
+        events = self._pending
+        if not events:
+            return
+        self._pending = []
+        if not self.input_types & InputType.keyboard:
+            pass
+        elif self._kbd_xkb is not None:
+            self._xkb_process(events)
+        else:
+            for wev in events:
+                self._event_forward(wev)
+            xlib.XFlush(self.replay_dpy)
+
+        self.stats['batches'] += 1
+        self.stats['events'] += len(events)
+        if len(events) > self.stats['max_batch']:
+            self.stats['max_batch'] = len(events)
+
+
+    def _event_forward(self, wev):
+        ev_type = wev.type & 0x7f
+        if xlib.KeyPress <= ev_type <= xlib.MotionNotify:
+            buf = self._send_buf
+            xlib.XWireToEvent(self._replay_dpy_addr, wev, buf.ev)
+            xlib.XSendEvent(self.replay_dpy, self.replay_win, False, 0, buf.ref)
+        elif ev_type in [xlib.FocusIn, xlib.FocusOut]:
             # Forward the event as a custom message in the same queue instead
             # of resetting the XIC directly, in order to preserve queued events
-            fwd_ev = xlib.XEvent()
-            fwd_ev.type = xlib.ClientMessage
-            fwd_ev.xclient.message_type = self.custom_atom
-            fwd_ev.xclient.format = 32
-            fwd_ev.xclient.data[0] = ev.type
-            xlib.XSendEvent(self.replay_dpy, self.replay_win, False, 0, fwd_ev)
-
-
-    def _event_callback(self, data):
-        self.callback(data)
-        return False
-
-    def _event_processed(self, data):
-        data.symbol = xlib.XKeysymToString(data.keysym)
-        if data.string is None:
-            data.string = keysym_to_unicode(data.keysym)
-        glib.idle_add(self._event_callback, data)
-
-
-    def _event_modifiers(self, kev, data):
-        data.modifiers = modifiers = {}
-        modifiers['shift'] = bool(kev.state & xlib.ShiftMask)
-        modifiers['caps_lock'] = bool(kev.state & xlib.LockMask)
-        modifiers['ctrl'] = bool(kev.state & xlib.ControlMask)
-        modifiers['alt'] = bool(kev.state & xlib.Mod1Mask)
-        modifiers['num_lock'] = bool(kev.state & xlib.Mod2Mask)
-        modifiers['hyper'] = bool(kev.state & xlib.Mod3Mask)
-        modifiers['super'] = bool(kev.state & xlib.Mod4Mask)
-        modifiers['alt_gr'] = bool(kev.state & xlib.Mod5Mask)
-
-
-    def _event_keypress(self, kev, data):
-        buf = xlib.create_string_buffer(16)
-        keysym = xlib.KeySym()
-        status = xlib.Status()
-        ret = xlib.Xutf8LookupString(self._kbd_replay_xic, kev, buf, len(buf),
-                                     xlib.byref(keysym), xlib.byref(status))
+            # (the focus window is the first field after the header)
+            fwd = self._fwd_buf
+            fwd.xclient_data[0] = ev_type
+            fwd.xclient_data[1] = wev.time
+            fwd.xclient_data[2] = wev.detail
+            xlib.XSendEvent(self.replay_dpy, self.replay_win, False, 0, fwd.ref)
+
+
+    def _event_keypress(self, kev_ref, data):
+        buf = self._kbd_buf
+        keysym = self._kbd_keysym
+        status = self._kbd_status
+        ret = xlib.Xutf8LookupString(self._kbd_replay_xic, kev_ref, buf, len(buf),
+                                     self._kbd_keysym_ref, self._kbd_status_ref)
         if ret != xlib.NoSymbol:
-            if 32 <= keysym.value <= 126:
-                # avoid ctrl sequences, just take the character value
-                data.string = chr(keysym.value)
-            else:
-                try:
-                    data.string = buf.value.decode('utf-8')
-                except UnicodeDecodeError:
-                    pass
+            try:
+                string = buf.value.decode('utf-8')
+            except UnicodeDecodeError:
+                string = None
+            data.string = lookup_string(keysym.value, string)
         data.keysym = keysym.value
         data.status = status.value
 
 
-    def _event_lookup(self, kev, data):
-        # this is mostly for debugging: we do not account for group/level
-        data.keysym = xlib.XkbKeycodeToKeysym(kev.display, kev.keycode, 0, 0)
+    def _event_lookup(self, keycode, state, data):
+        data.keysym = keymap_lookup(self._kbd_keymap, keycode, state,
+                                    self.kbd_levels)
+
+
+    def __del__(self):
+        # the wakeup pipe outlives the thread, so that late commands are safe
+        os.close(self._wake_r)
+        os.close(self._wake_w)
 
 
     def start(self):
@@ -238,90 +576,338 @@ class InputListener(threading.Thread):
 
 
     def stop(self):
+        # the lock is only held while the thread is initializing: a failed
+        # initialization leaves the listener stopped
         with self.lock:
             if not self.stopped:
                 self.stopped = True
-                xlib.XRecordDisableContext(self.control_dpy, self.record_ctx)
+                self.queue.close()
+                self._capture_disable()
+                self._wakeup()
+
+
+    def flush(self):
+        # process pending replies and deliver queued events right away
+        self._command(self._command_flush)
+
+
+    def reconfigure(self, kbd_translate=None, kbd_levels=None):
+        self._command(lambda: self._command_reconfigure(kbd_translate, kbd_levels))
+
+
+    def _command(self, func):
+        self._commands.append(func)
+        self._wakeup()
+
+
+    def _command_flush(self):
+        xlib.XFlush(self.replay_dpy)
+        self._event_flush()
+        self._replay_drain()
+
+
+    def _command_reconfigure(self, kbd_translate, kbd_levels):
+        if kbd_translate is not None:
+            self.kbd_translate = kbd_translate
+        if kbd_levels is not None:
+            self.kbd_levels = kbd_levels
+        if self.replay_dpy and self.input_types & InputType.keyboard and \
+           self._kbd_xkb is None:
+            # started without translation
+            self._kbd_xkb_init()
+
+
+    def _wakeup(self):
+        try:
+            os.write(self._wake_w, b'\0')
+        except BlockingIOError:
+            # the pipe is full: a wakeup is already pending
+            pass
+
+
+    def _wakeup_drain(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._commands:
+            self._commands.popleft()()
 
 
     def _kbd_init(self):
-        self._kbd_last_ev = xlib.XEvent()
+        self._kbd_last = None
+        self._kbd_buf = xlib.create_string_buffer(16)
+        self._kbd_keysym = xlib.KeySym()
+        self._kbd_keysym_ref = xlib.byref(self._kbd_keysym)
+        self._kbd_status = xlib.Status()
+        self._kbd_status_ref = xlib.byref(self._kbd_status)
+        self._kbd_keymap = keymap_table(self.replay_dpy)
+
+        self._kbd_xkb = None
+        self._kbd_composer = None
+        self._kbd_xkb_init()
+
+        self._kbd_replay_xim = xlib.XOpenIM(self.replay_dpy, None, None, None)
+        if not self._kbd_replay_xim:
+            raise Exception("Cannot initialize input method")
+
+        # on-the-spot preedit callbacks, shared by all XICs (we need to keep
+        # the procs alive for as long as the XICs exist)
+        self._kbd_preedits = {}
+        self._kbd_preedit_procs = [xlib.XICProc(self._preedit_start),
+                                   xlib.XIMProc(self._preedit_done),
+                                   xlib.XIMProc(self._preedit_draw),
+                                   xlib.XIMProc(self._preedit_caret)]
+        self._kbd_preedit_cbs = [xlib.XIMCallback(None, xlib.cast(proc, xlib.c_void_p))
+                                 for proc in self._kbd_preedit_procs]
+
+        # XICs are cached per focused client window, so that switching
+        # windows preserves the composition state of each
+        self._kbd_xics = OrderedDict()
+        self._kbd_replay_xic = self._kbd_create_ic()
+        self._kbd_xics[None] = self._kbd_replay_xic
+        xlib.XSetICFocus(self._kbd_replay_xic)
+
 
+    def _kbd_xkb_init(self):
+        # local translation, unless an input method needs to see the events;
+        # composition is then performed with the compiled Compose table
+        if self.kbd_translator == 'xkb' and self.kbd_translate and not im_active():
+            self._kbd_xkb = xkb.XkbTranslator(self.replay_dpy)
+            if self.kbd_compose:
+                self._kbd_composer = compose.Composer(compose.load_table())
+
+
+    def _kbd_create_ic(self):
         if self.kbd_compose:
+            # prefer on-the-spot composition, reporting the preedit string
+            start, done, draw, caret = self._kbd_preedit_cbs
+            attrs = xlib.XVaCreateNestedList(0,
+                                             xlib.XNPreeditStartCallback, xlib.byref(start),
+                                             xlib.XNPreeditDoneCallback, xlib.byref(done),
+                                             xlib.XNPreeditDrawCallback, xlib.byref(draw),
+                                             xlib.XNPreeditCaretCallback, xlib.byref(caret),
+                                             None)
+            xic = xlib.XCreateIC(self._kbd_replay_xim,
+                                 xlib.XNClientWindow, self.replay_win,
+                                 xlib.XNInputStyle, xlib.XIMPreeditCallbacks | xlib.XIMStatusNothing,
+                                 xlib.XNPreeditAttributes, xlib.c_void_p(attrs),
+                                 None)
+            xlib.XFree(attrs)
+            if xic:
+                return xic
+
+            # not supported by the input method
             style = xlib.XIMPreeditNothing | xlib.XIMStatusNothing
         else:
             style = xlib.XIMPreeditNone | xlib.XIMStatusNone
 
-        # TODO: implement preedit callbacks for on-the-spot composition
-        #       (this would fix focus-stealing for the global IM state)
-        self._kbd_replay_xim = xlib.XOpenIM(self.replay_dpy, None, None, None)
-        if not self._kbd_replay_xim:
-            raise Exception("Cannot initialize input method")
+        return xlib.XCreateIC(self._kbd_replay_xim,
+                              xlib.XNClientWindow, self.replay_win,
+                              xlib.XNInputStyle, style,
+                              None)
 
-        self._kbd_replay_xic = xlib.XCreateIC(self._kbd_replay_xim,
-                                              xlib.XNClientWindow, self.replay_win,
-                                              xlib.XNInputStyle, style,
-                                              None)
-        xlib.XSetICFocus(self._kbd_replay_xic)
 
+    def _preedit_update(self, xic, text):
+        self._kbd_preedits[xic] = text
+        if xic == xlib.cast(self._kbd_replay_xic, xlib.c_void_p).value:
+            self._event_queue(KeyData(preedit=text))
 
-    def _kbd_del(self):
-        xlib.XDestroyIC(self._kbd_replay_xic)
-        xlib.XCloseIM(self._kbd_replay_xim)
+
+    def _preedit_start(self, xic, client_data, call_data):
+        self._kbd_preedits[xic] = ''
+        return -1
+
+
+    def _preedit_done(self, xic, client_data, call_data):
+        self._preedit_update(xic, '')
+
+
+    def _preedit_draw(self, xic, client_data, call_data):
+        draw = xlib.cast(call_data, xlib.POINTER(xlib.XIMPreeditDrawCallbackStruct)).contents
+        chars = ''
+        if draw.text:
+            text = draw.text.contents
+            if not text.string:
+                pass
+            elif text.encoding_is_wchar:
+                chars = xlib.wstring_at(text.string, text.length)
+            else:
+                chars = xlib.string_at(text.string).decode('utf-8', 'replace')
+        old = self._kbd_preedits.get(xic, '')
+        new = old[:draw.chg_first] + chars + old[draw.chg_first + draw.chg_length:]
+        self._preedit_update(xic, new)
+
+
+    def _preedit_caret(self, xic, client_data, call_data):
+        pass
+
+
+    def _kbd_focus(self, window):
+        # each focus change used to reset the input context
+        self.stats['xic_resets_avoided'] += 1
+        xic = self._kbd_xics.pop(window, None)
+        if xic is not None:
+            self.stats['xic_hits'] += 1
+        else:
+            self.stats['xic_misses'] += 1
+            xic = self._kbd_create_ic()
+            if len(self._kbd_xics) >= XIC_CACHE_SIZE:
+                # the active XIC is always the most recently used
+                _, old = self._kbd_xics.popitem(last=False)
+                self._kbd_preedits.pop(xlib.cast(old, xlib.c_void_p).value, None)
+                xlib.XDestroyIC(old)
+                self.stats['xic_evictions'] += 1
+        self._kbd_xics[window] = xic
+
+        if xic is not self._kbd_replay_xic:
+            old_preedit = self._kbd_preedits.get(xlib.cast(self._kbd_replay_xic, xlib.c_void_p).value)
+            xlib.XUnsetICFocus(self._kbd_replay_xic)
+            xlib.XSetICFocus(xic)
+            self._kbd_replay_xic = xic
+
+            # show the composition in progress for the new window, if any
+            preedit = self._kbd_preedits.get(xlib.cast(xic, xlib.c_void_p).value)
+            if old_preedit or preedit:
+                self._event_queue(KeyData(preedit=preedit or ''))
 
 
-    def _kbd_process(self, ev):
-        if ev.type == xlib.ClientMessage and \
-           ev.xclient.message_type == self.custom_atom:
-            if ev.xclient.data[0] in [xlib.FocusIn, xlib.FocusOut]:
-                # we do not keep track of multiple XICs, just reset
-                xic = xlib.Xutf8ResetIC(self._kbd_replay_xic)
-                if xic is not None: xlib.XFree(xic)
+    def _kbd_del(self):
+        if self._kbd_xkb is not None:
+            self._kbd_xkb.close()
+            self._kbd_xkb = None
+        for xic in self._kbd_xics.values():
+            xlib.XDestroyIC(xic)
+        self._kbd_xics.clear()
+        if self._kbd_replay_xim:
+            xlib.XCloseIM(self._kbd_replay_xim)
+            self._kbd_replay_xim = None
+
+
+    def _kbd_process(self, buf):
+        ev = buf.ev
+        kev = buf.xkey
+        ev_type = ev.type
+        if ev_type == xlib.MappingNotify:
+            xlib.XRefreshKeyboardMapping(buf.xmapping_ref)
+            self._kbd_keymap = keymap_table(self.replay_dpy)
+            if self._kbd_xkb is not None:
+                self._kbd_xkb.reload()
+            self._keysym_cache.clear()
+            return
+        if ev_type == xlib.ClientMessage and \
+           buf.xclient.message_type == self.custom_atom:
+            if buf.xclient_data[0] == xlib.FocusIn:
+                # only the window receiving the focus itself: ancestors and
+                # frames (virtual), the pointer window and the root get
+                # their own FocusIn for the same change
+                if buf.xclient_data[2] in FOCUS_DETAILS:
+                    self._kbd_focus(buf.xclient_data[1])
                 return
-            elif ev.type in [xlib.KeyPress, xlib.KeyRelease]:
+            elif buf.xclient_data[0] == xlib.FocusOut:
+                # keep the state of the XIC for when the window comes back
+                return
+            elif ev_type in [xlib.KeyPress, xlib.KeyRelease]:
                 # fake keyboard event data for XFilterEvent
-                ev.xkey.send_event = False
-                ev.xkey.window = self.replay_win
+                kev.send_event = False
+                kev.window = self.replay_win
 
         # pass _all_ events to XFilterEvent
-        filtered = bool(xlib.XFilterEvent(ev, 0))
-        if ev.type == xlib.KeyRelease and \
-           phantom_release(self.replay_dpy, ev.xkey):
+        filtered = bool(xlib.XFilterEvent(buf.ref, 0))
+        if ev_type == xlib.KeyRelease and \
+           phantom_release(self.replay_dpy, kev, self._peek_buf):
             return
-        if ev.type not in [xlib.KeyPress, xlib.KeyRelease]:
+        if ev_type not in [xlib.KeyPress, xlib.KeyRelease]:
             return
 
         # generate new keyboard event
-        data = KeyData()
-        data.filtered = filtered
-        data.pressed = (ev.type == xlib.KeyPress)
-        data.repeated = (ev.type == self._kbd_last_ev.type and \
-                         ev.xkey.state == self._kbd_last_ev.xkey.state and \
-                         ev.xkey.keycode == self._kbd_last_ev.xkey.keycode)
-        data.mods_mask = ev.xkey.state
-        self._event_modifiers(ev.xkey, data)
+        state = kev.state
+        keycode = kev.keycode
+        data = self._kbd_keydata(ev_type, state, keycode, filtered)
         if not data.filtered and data.pressed and self.kbd_translate:
-            self._event_keypress(ev.xkey, data)
+            self._event_keypress(buf.xkey_ref, data)
         else:
-            self._event_lookup(ev.xkey, data)
+            self._event_lookup(keycode, state, data)
         self._event_processed(data)
-        self._kbd_last_ev = ev
 
 
-    def run(self):
-        # control connection
-        self.control_dpy = xlib.XOpenDisplay(None)
-        xlib.XSynchronize(self.control_dpy, True)
+    def _kbd_keydata(self, ev_type, state, keycode, filtered):
+        last = (ev_type, state, keycode)
+        data = KeyData()
+        data.filtered = filtered
+        data.pressed = (ev_type == xlib.KeyPress)
+        data.repeated = (last == self._kbd_last)
+        data.mods_mask = state
+        self._kbd_last = last
+        return data
+
+
+    def _xkb_process(self, events):
+        # local translation: recorded key events are never replayed
+        for i, wev in enumerate(events):
+            ev_type = wev.type & 0x7f
+            if ev_type not in [xlib.KeyPress, xlib.KeyRelease]:
+                continue
+            if ev_type == xlib.KeyRelease and i + 1 < len(events):
+                # phantom release from auto-repeat
+                nxt = events[i + 1]
+                if nxt.type & 0x7f == xlib.KeyPress and nxt.detail == wev.detail and \
+                   nxt.state == wev.state and nxt.time == wev.time:
+                    continue
+
+            data = self._kbd_keydata(ev_type, wev.state, wev.detail, False)
+            if data.pressed and self.kbd_translate:
+                data.keysym, string = self._kbd_xkb.lookup(wev.detail, wev.state)
+                data.string = lookup_string(data.keysym, string)
+                if self._kbd_composer is not None:
+                    self._event_compose(self._kbd_composer, data)
+            else:
+                self._event_lookup(wev.detail, wev.state, data)
+            self._event_processed(data)
+
+
+    def _replay_drain(self):
+        # process everything already read from the replay connection in one
+        # go: XEventsQueued(QueuedAlready) does not touch the socket
+        buf = self._replay_buf
+        count = xlib.XEventsQueued(self.replay_dpy, xlib.QueuedAfterReading)
+        while count:
+            for _ in range(count):
+                xlib.XNextEvent(self.replay_dpy, buf.ref)
+                if self.input_types & InputType.keyboard:
+                    self._kbd_process(buf)
+            count = xlib.XEventsQueued(self.replay_dpy, xlib.QueuedAlready)
+
 
+    def _setup(self):
         # unmapped replay window
         self.replay_dpy = xlib.XOpenDisplay(None)
+        self._replay_dpy_addr = xlib.cast(self.replay_dpy, xlib.c_void_p).value
         self.custom_atom = xlib.XInternAtom(self.replay_dpy, b"SCREENKEY", False)
-        replay_fd = xlib.XConnectionNumber(self.replay_dpy)
+        fwd = self._fwd_buf
+        fwd.ev.type = xlib.ClientMessage
+        fwd.xclient.message_type = self.custom_atom
+        fwd.xclient.format = 32
+        self.replay_fd = xlib.XConnectionNumber(self.replay_dpy)
         self.replay_win = create_replay_window(self.replay_dpy)
 
         if self.input_types & InputType.keyboard:
             self._kbd_init()
 
+        # capture connection
+        if self.capture == 'xi2':
+            self._xi2_setup()
+        else:
+            self._record_setup()
+        self.capture_fd = xlib.XConnectionNumber(self.capture_dpy)
+
+
+    def _record_setup(self):
+        # control connection
+        self.control_dpy = xlib.XOpenDisplay(None)
+        xlib.XSynchronize(self.control_dpy, True)
+
         # initialize recording context
         ev_ranges = []
         dev_ranges = []
@@ -334,50 +920,267 @@ class InputListener(threading.Thread):
             dev_ranges.append([xlib.MotionNotify, xlib.MotionNotify])
         self.record_ctx = record_context(self.control_dpy, ev_ranges, dev_ranges);
 
-        record_dpy = xlib.XOpenDisplay(None)
-        record_fd = xlib.XConnectionNumber(record_dpy)
+        self.capture_dpy = xlib.XOpenDisplay(None)
         # we need to keep the record_ref alive(!)
-        record_ref = record_enable(record_dpy, self.record_ctx, self._event_received)
+        self._record_ref = record_enable(self.capture_dpy, self.record_ctx, self._event_received)
+
+
+    def _xi2_setup(self):
+        # Raw events are delivered to the root window only, for the physical
+        # device events of every client, and carry the source device. They
+        # have no state though, which is tracked through XkbStateNotify on
+        # the same connection (state changes caused by a key are sent after
+        # its raw event, matching the core semantics). The server generates
+        # no raw events for auto-repeat, which XKB performs in software on
+        # top of the device events: a held key shows as a single press.
+        if xlib.libXi is None:
+            raise Exception("libXi is required for the xi2 capture")
+        dpy = self.capture_dpy = xlib.XOpenDisplay(None)
+        opcode, event, error = xlib.c_int(), xlib.c_int(), xlib.c_int()
+        if not xlib.XQueryExtension(dpy, b"XInputExtension", xlib.byref(opcode),
+                                    xlib.byref(event), xlib.byref(error)):
+            raise Exception("XInput extension not available")
+        # raw events are only delivered during grabs (menus, WM bindings,
+        # games) to clients announcing XI 2.1 or later
+        major, minor = xlib.c_int(2), xlib.c_int(2)
+        if xlib.XIQueryVersion(dpy, xlib.byref(major), xlib.byref(minor)) != 0 or \
+           (major.value, minor.value) < (2, 1):
+            raise Exception("XInput 2.1 not available")
+        self._xi2_opcode = opcode.value
+
+        xkb_opcode, xkb_event, xkb_error = xlib.c_int(), xlib.c_int(), xlib.c_int()
+        xkb_major, xkb_minor = xlib.c_int(1), xlib.c_int(0)
+        if not xlib.XkbQueryExtension(dpy, xlib.byref(xkb_opcode), xlib.byref(xkb_event),
+                                      xlib.byref(xkb_error), xlib.byref(xkb_major),
+                                      xlib.byref(xkb_minor)):
+            raise Exception("XKB extension not available")
+        self._xi2_xkb_event = xkb_event.value
+        xlib.XkbSelectEventDetails(dpy, xlib.XkbUseCoreKbd, xlib.XkbStateNotify,
+                                   xlib.XkbAllStateComponentsMask,
+                                   xlib.XkbAllStateComponentsMask)
+        state = xlib.XkbStateRec()
+        xlib.XkbGetState(dpy, xlib.XkbUseCoreKbd, xlib.byref(state))
+        self._xi2_state = xkb_core_state(state)
+
+        self._xi2_root = xlib.XDefaultRootWindow(dpy)
+        xi2_select(dpy, self._xi2_root, [evtype for evtype, (input_type, _) in XI2_EVENTS.items()
+                                         if self.input_types & input_type])
+        xlib.XFlush(dpy)
+        self._xi2_buf = XEventBuffer()
+
+
+    def _capture_disable(self):
+        # only needed to interrupt XRecord: the event loop is woken up anyway
+        if self.capture != 'xi2':
+            xlib.XRecordDisableContext(self.control_dpy, self.record_ctx)
+
+
+    def _capture_process(self):
+        if self.capture == 'xi2':
+            self._xi2_process()
+        else:
+            xlib.XRecordProcessReplies(self.capture_dpy)
+
+
+    def _xi2_process(self):
+        dpy = self.capture_dpy
+        buf = self._xi2_buf
+        count = xlib.XEventsQueued(dpy, xlib.QueuedAfterReading)
+        while count:
+            for _ in range(count):
+                xlib.XNextEvent(dpy, buf.ref)
+                ev_type = buf.ev.type
+                if ev_type == self._xi2_xkb_event:
+                    if buf.xkbstate.xkb_type == xlib.XkbStateNotify:
+                        self._xi2_state = xkb_core_state(buf.xkbstate)
+                elif ev_type == xlib.GenericEvent and \
+                     buf.xcookie.extension == self._xi2_opcode and \
+                     xlib.XGetEventData(dpy, buf.xcookie_ref):
+                    raw = xlib.cast(buf.xcookie.data, xlib.POINTER(xlib.XIRawEvent)).contents
+                    self._xi2_event(raw)
+                    xlib.XFreeEventData(dpy, buf.xcookie_ref)
+            count = xlib.XEventsQueued(dpy, xlib.QueuedAlready)
+
+
+    def _xi2_event(self, raw):
+        if self.devices is not None and raw.sourceid not in self.devices:
+            return
+        _, ev_type = XI2_EVENTS[raw.evtype]
+        root = self._xi2_root
+        # raw events have no position: coordinates are left at zero
+        self._pending.append(xlib.WireEvent(ev_type, raw.detail, 0, raw.time, root, root,
+                                            0, 0, 0, 0, 0, self._xi2_state, 1))
+
+
+    def _teardown(self):
+        # also called when _setup failed halfway: only release what exists
+        if self.record_ctx:
+            xlib.XRecordFreeContext(self.control_dpy, self.record_ctx)
+            self.record_ctx = None
+        if self.control_dpy:
+            xlib.XCloseDisplay(self.control_dpy)
+            self.control_dpy = None
+        self._record_ref = None
+        self._xi2_buf = None
+        if self.capture_dpy:
+            xlib.XCloseDisplay(self.capture_dpy)
+            self.capture_dpy = None
 
-        # event loop
-        self.lock.release()
-        while True:
-            with self.lock:
-                if self.stopped:
-                    break
+        if self.input_types & InputType.keyboard:
+            self._kbd_del()
+
+        if self.replay_win:
+            xlib.XDestroyWindow(self.replay_dpy, self.replay_win)
+            self.replay_win = None
+        if self.replay_dpy:
+            xlib.XCloseDisplay(self.replay_dpy)
+            self.replay_dpy = None
+
+
+    def _process(self, r_fd):
+        if self.capture_fd in r_fd:
+            self._capture_process()
+            self._event_flush()
+
+        if self.replay_fd in r_fd:
+            self._replay_drain()
+
+
+    def _ready_fds(self):
+        # connections with data already buffered by Xlib, which select
+        # would not report
+        r_fd = []
+        # XPending also reads the XRecord replies, which never count as
+        # events: the intercept might have left decoded events pending
+        if xlib.XPending(self.capture_dpy) or self._pending:
+            r_fd.append(self.capture_fd)
+        if xlib.XEventsQueued(self.replay_dpy, xlib.QueuedAfterReading):
+            r_fd.append(self.replay_fd)
+        return r_fd
+
+
+    def _setup_safe(self):
+        # never leave a half-initialized capture behind
+        try:
+            self._setup()
+        except Exception:
+            self.stopped = True
+            self._teardown()
+            raise
+
+
+    def run(self):
+        try:
+            self._setup_safe()
+        finally:
+            # stop() waits on the lock, also when _setup failed
+            self.lock.release()
 
-            r_fd = []
-            if xlib.XPending(record_dpy):
-                r_fd.append(record_fd)
-            if xlib.XPending(self.replay_dpy):
-                r_fd.append(replay_fd)
+        # event loop
+        while not self.stopped:
+            r_fd = self._ready_fds()
             if not r_fd:
-                r_fd, _, _ = select.select([record_fd, replay_fd], [], [])
+                r_fd, _, _ = select.select([self.capture_fd, self.replay_fd, self._wake_r], [], [])
             if not r_fd:
                 break
+            self.stats['wakeups'] += 1
 
-            if record_fd in r_fd:
-                xlib.XRecordProcessReplies(record_dpy)
-                xlib.XFlush(self.replay_dpy)
+            if self._wake_r in r_fd:
+                self._wakeup_drain()
+                if self.stopped:
+                    break
 
-            if replay_fd in r_fd:
-                ev = xlib.XEvent()
-                xlib.XNextEvent(self.replay_dpy, xlib.byref(ev))
-                if self.input_types & InputType.keyboard:
-                    self._kbd_process(ev)
+            self._process(r_fd)
 
-        # finalize
-        xlib.XRecordFreeContext(self.control_dpy, self.record_ctx)
-        xlib.XCloseDisplay(self.control_dpy)
-        xlib.XCloseDisplay(record_dpy)
-        del record_ref
+        self._teardown()
 
-        if self.input_types & InputType.keyboard:
-            self._kbd_del()
 
-        xlib.XDestroyWindow(self.replay_dpy, self.replay_win)
-        xlib.XCloseDisplay(self.replay_dpy)
 
+class MainLoopInputListener(InputListener, metaclass=abc.ABCMeta):
+    # Thread-free variant running on an external main loop: the X
+    # connections are watched by the loop (see _watch/_unwatch, provided by
+    # the subclass for each loop) and events are delivered synchronously at
+    # the end of each dispatch, without crossing threads.
+    _main_loop = True
+
+
+    @abc.abstractmethod
+    def _watch(self, fds):
+        pass
+
+
+    @abc.abstractmethod
+    def _unwatch(self):
+        pass
+
+
+    def start(self):
+        self.stopped = False
+        self._setup_safe()
+        self._watch([self.capture_fd, self.replay_fd])
+
+        # Xlib might have queued events while initializing
+        self._dispatch()
+
+
+    def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.queue.close()
+        self._unwatch()
+        self._capture_disable()
+        self._teardown()
+
+
+    def join(self, timeout=None):
+        pass
+
+
+    def is_alive(self):
+        return not self.stopped
+
+
+    def _command(self, func):
+        func()
+
+
+    def _event_wakeup(self):
+        # delivery happens at the end of _dispatch
+        pass
+
+
+    def _dispatch(self, fd=None):
+        # the fd that fired is always processed: Xlib cannot report data
+        # waiting on the socket, and XRecord replies never count as events
+        self.stats['wakeups'] += 1
+        r_fd = self._ready_fds()
+        if fd is not None and fd not in r_fd:
+            r_fd.append(fd)
+        while r_fd and not self.stopped:
+            self._process(r_fd)
+            r_fd = self._ready_fds()
+        self._event_callback()
+
+
+
+class GLibInputListener(MainLoopInputListener):
+    # runs on the default GLib main context using fd sources
+    def _watch(self, fds):
+        self._sources = [glib.unix_fd_add_full(glib.PRIORITY_DEFAULT, fd,
+                                               glib.IOCondition.IN, self._fd_ready)
+                         for fd in fds]
+
+
+    def _unwatch(self):
+        for source in self._sources:
+            glib.source_remove(source)
+        self._sources = []
+
+
+    def _fd_ready(self, fd, condition):
+        self._dispatch(fd)
+        return True
 
 
 if __name__ == '__main__':
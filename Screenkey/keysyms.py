@@ -1803,3 +1803,12 @@ KEYSYMS = {
 0xfe62:   [u'\u031b',   'f'],   # dead_horn
 
 }
+
+
+def keysym_to_unicode(keysym):
+    if 0x01000000 <= keysym <= 0x0110FFFF:
+        return chr(keysym - 0x01000000)
+    keydata = KEYSYMS.get(keysym)
+    if keydata is not None:
+        return keydata[0]
+    return None
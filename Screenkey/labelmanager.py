@@ -5,10 +5,14 @@ gi.require_version('Gtk', '3.0')
 
 from gi.repository import GLib
 
-from inputlistener import InputListener, InputType
+from inputlistener import InputType
+import backends
 
+from array import array
+from bisect import bisect_right
 from collections import namedtuple
-from datetime import datetime
+import sys
+import time
 
 import gettext
 _ = gettext.gettext
@@ -25,7 +29,7 @@ _ = gettext.gettext
 
 ReplData = namedtuple('ReplData', ['value', 'font'])
 KeyRepl  = namedtuple('KeyRepl',  ['bk_stop', 'silent', 'spaced', 'repl'])
-KeyData  = namedtuple('KeyData',  ['stamp', 'is_ctrl', 'bk_stop', 'silent', 'spaced', 'markup'])
+KeyData  = namedtuple('KeyData',  ['is_ctrl', 'bk_stop', 'silent', 'spaced', 'markup', 'count'])
 
 REPLACE_SYMS = {
     # Regular keys
@@ -114,6 +118,13 @@ REPLACE_SYMS = {
 
 WHITESPACE_SYMS = {'Tab', 'ISO_Left_Tab', 'Return', 'space', 'KP_Enter'}
 
+# maximum time (in seconds) to wait for the listener thread to exit
+STOP_TIMEOUT = 1.0
+
+# entries allowed past the history size before compacting: the whole
+# markup is recomputed when this happens, so don't do it for every key
+HISTORY_CHUNK = 256
+
 MODS_MAP = {
     'normal': 0,
     'emacs': 1,
@@ -139,6 +150,14 @@ REPLACE_MODS = {
 }
 
 
+def listener_options(key_mode):
+    # kbd_compose, kbd_translate and kbd_levels of the listener
+    compose = (key_mode == 'composed')
+    translate = (key_mode in ['composed', 'translated'])
+    levels = (key_mode != 'raw')
+    return compose, translate, levels
+
+
 def keysym_to_mod(keysym):
     for k, v in MODS_SYMS.items():
         if keysym in v:
@@ -150,7 +169,10 @@ class LabelManager(object):
     def __init__(
             self,
             listener, logger, key_mode, bak_mode, mods_mode, mods_only,
-            multiline, vis_shift, vis_space, recent_thr, compr_cnt, ignore, pango_ctx
+            multiline, vis_shift, vis_space, recent_thr, compr_cnt, ignore, pango_ctx,
+            listener_mode='thread', translator='xim',
+            capture='auto', devices=None, history=1000, expire=0,
+            clock=time.monotonic
     ):
         self.key_mode = key_mode
         self.bak_mode = bak_mode
@@ -159,15 +181,26 @@ class LabelManager(object):
         self.logger = logger
         self.listener = listener
         self.data = []
+        self.stamps = array('d')
         self.enabled = True
         self.mods_only = mods_only
         self.multiline = multiline
         self.vis_shift = vis_shift
         self.vis_space = vis_space
         self.recent_thr = recent_thr
+        self.clock = clock
         self.compr_cnt = compr_cnt
         self.ignore = ignore
+        self.listener_mode = listener_mode
+        self.translator = translator
+        self.capture = capture
+        self.devices = devices
+        self.history = history
+        self.expire = expire
+        self.preedit = ''
         self.kl = None
+        self._expire_source = None
+        self.clear()
         self.font_families = {x.get_name() for x in pango_ctx.list_families()}
         self.update_replacement_map()
 
@@ -177,24 +210,135 @@ class LabelManager(object):
 
 
     def start(self):
-        self.stop()
-        compose = (self.key_mode == 'composed')
-        translate = (self.key_mode in ['composed', 'translated'])
-        self.kl = InputListener(self.key_press, InputType.keyboard, compose, translate)
+        if not self.stop():
+            # never run two captures at once
+            self.logger.error("Previous listener still running, not restarting")
+            return
+        compose, translate, levels = listener_options(self.key_mode)
+        self.kl = backends.create(self.capture, self.key_press_batch, InputType.keyboard,
+                                  compose, translate, levels, batch=True,
+                                  listener_mode=self.listener_mode,
+                                  translator=self.translator, devices=self.devices)
+        if self.devices and backends.Capability.device_ids not in \
+           backends.BACKENDS[self.kl.backend].capabilities:
+            self.logger.warning("Device filtering is not supported by the {} backend"
+                                .format(self.kl.backend))
         self.kl.start()
-        self.logger.debug("Thread started")
+        self.logger.debug("Listener started ({}, {})".format(self.kl.backend, self.listener_mode))
 
 
     def stop(self):
+        if self._expire_source is not None:
+            GLib.source_remove(self._expire_source)
+            self._expire_source = None
         if self.kl:
+            start = time.monotonic()
             self.kl.stop()
-            self.logger.debug("Thread stopped.")
-            self.kl.join()
+            self.kl.join(STOP_TIMEOUT)
+            elapsed = (time.monotonic() - start) * 1000
+            if self.kl.is_alive():
+                # keep the reference: the capture is still shutting down
+                self.logger.warning("Thread did not stop within {:.0f}ms".format(elapsed))
+                return False
+            self.logger.debug("Thread stopped in {:.1f}ms.".format(elapsed))
             self.kl = None
+        return True
+
+
+    def set_key_mode(self, key_mode):
+        # the running listener switches translation and levels by itself:
+        # only a change of composition needs a new capture
+        compose, translate, levels = listener_options(key_mode)
+        restart = compose != listener_options(self.key_mode)[0]
+        self.key_mode = key_mode
+        if self.kl is None:
+            return
+        if restart or not hasattr(self.kl, 'reconfigure'):
+            self.start()
+        else:
+            self.kl.reconfigure(translate, levels)
+            self.logger.debug("Listener reconfigured ({})".format(key_mode))
 
 
     def clear(self):
         self.data = []
+        self.stamps = array('d')
+        self.markup = ''
+        self._reset_segments()
+
+
+    def _reset_segments(self):
+        self._segments = []
+        self._rendered = []
+        self._prefix = ''
+        self._prefix_ends = []
+
+
+    def push_key(self, is_ctrl, bk_stop, silent, spaced, markup):
+        # consecutive repeats of the same key are run-length encoded: the
+        # last entry counts them, and is stamped with the latest one
+        stamp = self.clock()
+        if len(self.data) and self.data[-1].markup == markup:
+            last = self.data[-1]
+            self.data[-1] = last._replace(count=last.count + 1)
+            self.stamps[-1] = stamp
+            return
+        # markup is interned, so that repeated keys share the same string
+        self.data.append(KeyData(is_ctrl, bk_stop, silent, spaced, sys.intern(markup), 1))
+        self.stamps.append(stamp)
+        if self.expire and self._expire_source is None:
+            self._expire_schedule()
+        if self.history and len(self.data) >= self.history + HISTORY_CHUNK:
+            # the label is ellipsized at the start: older entries are not
+            # visible anymore and can be dropped
+            del self.data[:-self.history]
+            del self.stamps[:-self.history]
+            self._reset_segments()
+
+
+    def _expire_schedule(self):
+        # stamps are monotonic, so the head always holds the next deadline:
+        # a single timeout is rescheduled after each expiry
+        delay = self.stamps[0] + self.expire - self.clock()
+        self._expire_source = GLib.timeout_add(max(0, int(delay * 1000)) + 1,
+                                               self._expire_timeout)
+
+
+    def _expire_timeout(self):
+        self._expire_source = None
+        if self.trim(self.clock() - self.expire):
+            self.update_text()
+        if len(self.data):
+            self._expire_schedule()
+        return False
+
+
+    def trim(self, stamp):
+        # drop the entries pressed before stamp from the head, keeping the
+        # rendered segments of the rest
+        cut = bisect_right(self.stamps, stamp)
+        if not cut:
+            return False
+        del self.data[:cut]
+        del self.stamps[:cut]
+        if cut >= len(self._segments):
+            self._reset_segments()
+            return True
+        del self._segments[:cut]
+        del self._rendered[:cut]
+
+        # the new head lost its predecessor, and with it its spacing
+        ends = self._prefix_ends
+        head = self._segment(0)
+        if len(ends) > cut:
+            offset = ends[cut] - len(head[0])
+            self._prefix = head[0] + self._prefix[ends[cut]:]
+            self._prefix_ends = [end - offset for end in ends[cut:]]
+        else:
+            self._prefix = ''
+            self._prefix_ends = []
+        self._segments[0] = head
+        return True
 
 
     def get_repl_markup(self, repl):
@@ -217,65 +361,154 @@ class LabelManager(object):
             self.replace_syms[k] = KeyRepl(v.bk_stop, v.silent, v.spaced, markup)
 
 
+    def _spacing(self, last, key, repeats):
+        # character block spacing
+        if len(last.markup) and last.markup[-1] == '\n':
+            return ''
+        elif key.is_ctrl or last.is_ctrl or key.spaced or last.spaced:
+            return ' '
+        elif key.bk_stop or last.bk_stop or repeats > self.compr_cnt:
+            return '<span font_family="sans">\u2009</span>'
+        return ''
+
+
+    def _segment(self, i):
+        # Markup contributed by data[i]. Consecutive entries never share the
+        # same markup, so each segment only depends on its predecessor.
+        # Returns (plain, lead, body): the markup without underline, and the
+        # split point where '<u>' goes when this is the first recent entry.
+        key = self.data[i]
+        lead = ''
+        if i != 0:
+            last = self.data[i - 1]
+            repeats = last.count - 1 if self.compr_cnt else 0
+            lead = self._spacing(last, key, repeats)
+
+        # disable ligatures
+        if len(key.markup) == 1 and 0x0300 <= ord(key.markup) <= 0x036F:
+            # workaround for pango not handling ZWNJ correctly for combining marks
+            zw = '\u180e'
+            body = key.markup + '\u200a'
+        elif len(key.markup):
+            zw = '\u200c'
+            body = key.markup
+        else:
+            # nothing to show, unless underlined
+            zw = ''
+            body = ''
+
+        # compress repeats: the first compr_cnt copies are shown, then the
+        # total count
+        shown = key.count
+        if self.compr_cnt and shown > self.compr_cnt:
+            shown = self.compr_cnt
+        if shown > 1:
+            sep = self._spacing(key, key, 0)
+            lead += (zw + body + sep) * (shown - 1)
+        if shown < key.count:
+            lead += zw + body
+            body = '<sub><small>…{}×</small></sub>'.format(key.count)
+            if len(key.markup) and key.markup[-1] == '\n':
+                body += '\n'
+            return (lead + body, lead, body)
+        return (lead + zw + body, lead + (zw or '\u200c'), body)
+
+
+    def _update_segments(self):
+        # entries only change at the tail: find the first one not rendered yet
+        # (by identity), and recompute from there
+        n = min(len(self.data), len(self._rendered))
+        while n and self.data[n - 1] is not self._rendered[n - 1]:
+            n -= 1
+        del self._segments[n:]
+        for i in range(n, len(self.data)):
+            self._segments.append(self._segment(i))
+        del self._rendered[n:]
+        self._rendered.extend(self.data[n:])
+        return n
+
+
+    def _recent_index(self, stamp):
+        # first segment to be underlined (stamps are monotonic)
+        i = bisect_right(self.stamps, stamp - self.recent_thr)
+        return i if i < len(self.data) else None
+
+
     def update_text(self):
-        markup = ""
-        recent = False
-        stamp = datetime.now()
-        repeats = 0
-        for i, key in enumerate(self.data):
-            if i != 0:
-                last = self.data[i - 1]
-
-                # compress repeats
-                if self.compr_cnt and key.markup == last.markup:
-                    repeats += 1
-                    if repeats < self.compr_cnt:
-                        pass
-                    elif i == len(self.data) - 1 or key.markup != self.data[i + 1].markup:
-                        if not recent and (stamp - key.stamp).total_seconds() < self.recent_thr:
-                            markup += '<u>'
-                            recent = True
-                        markup += '<sub><small>…{}×</small></sub>'.format(repeats + 1)
-                        if len(key.markup) and key.markup[-1] == '\n':
-                            markup += '\n'
-                        continue
-                    else:
-                        continue
-
-                # character block spacing
-                if len(last.markup) and last.markup[-1] == '\n':
-                    pass
-                elif key.is_ctrl or last.is_ctrl or key.spaced or last.spaced:
-                    markup += ' '
-                elif key.bk_stop or last.bk_stop or repeats > self.compr_cnt:
-                    markup += '<span font_family="sans">\u2009</span>'
-                if key.markup != last.markup:
-                    repeats = 0
-
-            key_markup = key.markup
-            if not recent and (stamp - key.stamp).total_seconds() < self.recent_thr:
-                recent = True
-                key_markup = '<u>' + key_markup
-
-            # disable ligatures
-            if len(key.markup) == 1 and 0x0300 <= ord(key.markup) <= 0x036F:
-                # workaround for pango not handling ZWNJ correctly for combining marks
-                markup += '\u180e' + key_markup + '\u200a'
-            elif len(key_markup):
-                markup += '\u200c' + key_markup
+        dirty = self._update_segments()
+        recent = self._recent_index(self.clock())
+
+        # finalized segments before the underline are kept joined (the last
+        # entry is still growing while the key repeats)
+        limit = len(self.data) - 1
+        if recent is not None:
+            limit = min(limit, recent)
+        limit = max(0, limit)
+        ends = self._prefix_ends
+        keep = min(limit, dirty)
+        if len(ends) > keep:
+            # entries were popped: truncate
+            self._prefix = self._prefix[:ends[keep - 1]] if keep else ''
+            del ends[keep:]
+        for seg in self._segments[len(ends):limit]:
+            self._prefix += seg[0]
+            ends.append(len(self._prefix))
+
+        if recent is None:
+            markup = self._prefix + ''.join(seg[0] for seg in self._segments[limit:])
+        else:
+            _, lead, body = self._segments[recent]
+            markup = self._prefix + \
+                ''.join(seg[0] for seg in self._segments[limit:recent]) + \
+                lead + '<u>' + body + \
+                ''.join(seg[0] for seg in self._segments[recent + 1:])
 
         if len(markup) and markup[-1] == '\n':
             markup = markup.rstrip('\n')
             if not self.vis_space and not self.data[-1].is_ctrl:
                 # always show some return symbol at the last line
                 markup += self.replace_syms['Return'].repl
-        if recent:
+        if recent is not None:
             markup += '</u>'
-        self.logger.debug("Label updated: %s." % repr(markup))
-        self.listener(markup)
+        self.markup = markup
+        self.logger.debug("Label updated: %r.", markup)
+        self.listener(markup + self.preedit_markup())
+
+
+    def preedit_markup(self):
+        if not self.preedit:
+            return ''
+        return '<i>' + GLib.markup_escape_text(self.preedit) + '</i>'
+
+
+    def update_preedit(self):
+        # only the tail changes: reuse the markup of the last update
+        self.logger.debug("Preedit updated: %r.", self.preedit)
+        self.listener(self.markup + self.preedit_markup())
 
 
     def key_press(self, event):
+        self.key_press_batch([event])
+
+
+    def key_press_batch(self, events):
+        # render once for the whole batch
+        update = preedit = False
+        for event in events:
+            if event.preedit is not None:
+                preedit |= (event.preedit != self.preedit)
+                self.preedit = event.preedit
+                continue
+            # coalesced auto-repeats are replayed count times
+            for _ in range(event.count):
+                update |= bool(self.key_event(event))
+        if update:
+            self.update_text()
+        elif preedit:
+            self.update_preedit()
+
+
+    def key_event(self, event):
         if event.pressed == False:
             self.logger.debug("Key released {:5}(ks): {}".format(event.keysym, event.symbol))
             return
@@ -312,8 +545,7 @@ class LabelManager(object):
                 update |= self.key_raw_mode(event)
             else:
                 update |= self.key_keysyms_mode(event)
-        if update:
-            self.update_text()
+        return update
 
 
     def key_normal_mode(self, event):
@@ -328,7 +560,7 @@ class LabelManager(object):
            mod == '' and not event.modifiers['shift']:
             key_repl = self.replace_syms.get(event.symbol)
             if self.bak_mode == 'normal':
-                self.data.append(KeyData(datetime.now(), False, *key_repl))
+                self.push_key(False, *key_repl)
                 return True
             else:
                 if not len(self.data):
@@ -341,10 +573,13 @@ class LabelManager(object):
                         pop = not last.bk_stop
                     else:
                         pop = not last.silent
-                if pop:
+                if pop and last.count > 1:
+                    self.data[-1] = last._replace(count=last.count - 1)
+                elif pop:
                     self.data.pop()
+                    self.stamps.pop()
                 else:
-                    self.data.append(KeyData(datetime.now(), False, *key_repl))
+                    self.push_key(False, *key_repl)
                 return True
 
         # Regular keys
@@ -389,16 +624,16 @@ class LabelManager(object):
                     state = event.modifiers[event.symbol.lower()]
                     repl += '(%s)' % (_('off') if state else _('on'))
 
-                self.data.append(KeyData(datetime.now(), False, key_repl.bk_stop,
-                                         key_repl.silent, key_repl.spaced, repl))
+                self.push_key(False, key_repl.bk_stop,
+                              key_repl.silent, key_repl.spaced, repl)
                 return True
         else:
             if self.mods_mode == 'emacs' or key_repl.repl[0] != mod[-1]:
                 repl = mod + key_repl.repl
             else:
                 repl = mod + '‟' + key_repl.repl + '”'
-            self.data.append(KeyData(datetime.now(), True, key_repl.bk_stop,
-                                     key_repl.silent, key_repl.spaced, repl))
+            self.push_key(True, key_repl.bk_stop,
+                          key_repl.silent, key_repl.spaced, repl)
             return True
 
         return False
@@ -429,15 +664,15 @@ class LabelManager(object):
                 state = event.modifiers[event.symbol.lower()]
                 repl += '(%s)' % (_('off') if state else _('on'))
 
-            self.data.append(KeyData(datetime.now(), False, key_repl.bk_stop,
-                                     key_repl.silent, key_repl.spaced, repl))
+            self.push_key(False, key_repl.bk_stop,
+                          key_repl.silent, key_repl.spaced, repl)
         else:
             if self.mods_mode == 'emacs' or key_repl.repl[0] != mod[-1]:
                 repl = mod + key_repl.repl
             else:
                 repl = mod + '‟' + key_repl.repl + '”'
-            self.data.append(KeyData(datetime.now(), True, key_repl.bk_stop,
-                                     key_repl.silent, key_repl.spaced, repl))
+            self.push_key(True, key_repl.bk_stop,
+                          key_repl.silent, key_repl.spaced, repl)
         return True
 
 
@@ -446,5 +681,5 @@ class LabelManager(object):
             value = event.symbol
         else:
             value = event.string or event.symbol
-        self.data.append(KeyData(datetime.now(), True, True, True, True, value))
+        self.push_key(True, True, True, True, value)
         return True
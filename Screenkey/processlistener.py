@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+# Out-of-process keyboard capture: the regular InputListener runs in a forked
+# child, which writes fixed-size KeyData records into a shared anonymous
+# mapping. The overlay process is woken up through an eventfd (or a pipe) and
+# reads the records back from the GLib main loop. Rendering stalls in the
+# overlay can no longer delay XRecordProcessReplies, and both sides can be
+# profiled separately.
+
+from inputlistener import InputListener, InputType, KeyData
+
+from gi.repository import GLib as glib
+
+import logging
+import mmap
+import multiprocessing
+import os
+import signal
+from struct import Struct
+
+
+# flags, string length, symbol length, keysym, status, mods_mask, count
+RECORD = Struct('=BBBxIiII32s64s12x')
+RECORD_STRING = 32
+RECORD_SYMBOL = 64
+
+FLAG_PRESSED = 0b000001
+FLAG_FILTERED = 0b000010
+FLAG_REPEATED = 0b000100
+FLAG_STRING = 0b001000
+FLAG_SYMBOL = 0b010000
+FLAG_STATUS = 0b100000
+FLAG_PREEDIT = 0b1000000
+FLAG_CONTINUED = 0b10000000
+
+# head, tail and dropped counters: head and dropped are only written by the
+# producer, tail only by the consumer
+HEADER = Struct('=QQQ')
+COUNTER = Struct('=Q')
+HEAD_OFFSET = 0
+TAIL_OFFSET = 8
+DROPPED_OFFSET = 16
+
+logger = logging.getLogger(__name__)
+
+
+def split_utf8(string, size):
+    # chunks of at most size bytes, never splitting a character
+    chunks = []
+    while len(string) > size:
+        end = size
+        while string[end] & 0xc0 == 0x80:
+            end -= 1
+        chunks.append(string[:end])
+        string = string[end:]
+    chunks.append(string)
+    return chunks
+
+
+def pack_records(data):
+    # RECORD fields for data: strings longer than RECORD_STRING go on in
+    # continuation records, each flagged by FLAG_CONTINUED on the previous one
+    flags = 0
+    if data.pressed: flags |= FLAG_PRESSED
+    if data.filtered: flags |= FLAG_FILTERED
+    if data.repeated: flags |= FLAG_REPEATED
+    string = symbol = b''
+    if data.preedit is not None:
+        # preedit events carry no key data: reuse the string field
+        flags |= FLAG_PREEDIT
+        string = data.preedit.encode('utf-8')
+    elif data.string is not None:
+        flags |= FLAG_STRING
+        string = data.string.encode('utf-8')
+    if data.symbol is not None:
+        flags |= FLAG_SYMBOL
+        symbol = data.symbol.encode('ascii')[:RECORD_SYMBOL]
+    status = 0
+    if data.status is not None:
+        flags |= FLAG_STATUS
+        status = data.status
+    chunks = split_utf8(string, RECORD_STRING)
+    records = [(flags, len(chunks[0]), len(symbol), data.keysym or 0, status,
+                data.mods_mask or 0, data.count, chunks[0], symbol)]
+    for chunk in chunks[1:]:
+        records[-1] = (records[-1][0] | FLAG_CONTINUED,) + records[-1][1:]
+        records.append((0, len(chunk), 0, 0, 0, 0, 0, chunk, b''))
+    return records
+
+
+def unpack_record(buf, offset):
+    # returns the KeyData and whether its string is continued
+    flags, string_len, symbol_len, keysym, status, mods_mask, count, \
+        string, symbol = RECORD.unpack_from(buf, offset)
+    data = KeyData(pressed=bool(flags & FLAG_PRESSED),
+                   filtered=bool(flags & FLAG_FILTERED),
+                   repeated=bool(flags & FLAG_REPEATED),
+                   keysym=keysym, mods_mask=mods_mask, count=count)
+    if flags & FLAG_PREEDIT:
+        data.preedit = string[:string_len].decode('utf-8', 'ignore')
+    elif flags & FLAG_STRING:
+        data.string = string[:string_len].decode('utf-8', 'ignore')
+    if flags & FLAG_SYMBOL:
+        data.symbol = symbol[:symbol_len].decode('ascii')
+    if flags & FLAG_STATUS:
+        data.status = status
+    return data, bool(flags & FLAG_CONTINUED)
+
+
+def unpack_continuation(buf, offset, data):
+    flags, string_len, *_, string, _ = RECORD.unpack_from(buf, offset)
+    chunk = string[:string_len].decode('utf-8', 'ignore')
+    if data.preedit is not None:
+        data.preedit += chunk
+    else:
+        data.string += chunk
+    return bool(flags & FLAG_CONTINUED)
+
+
+class EventRing():
+    # single-producer/single-consumer ring of KeyData records on a shared
+    # anonymous mapping, which is inherited by the forked capture process
+    def __init__(self, slots=1024):
+        self.slots = slots
+        self.mem = mmap.mmap(-1, HEADER.size + slots * RECORD.size)
+
+
+    def _offset(self, index):
+        return HEADER.size + (index % self.slots) * RECORD.size
+
+
+    def write(self, events):
+        head, tail, dropped = HEADER.unpack_from(self.mem, 0)
+        for data in events:
+            records = pack_records(data)
+            if head - tail + len(records) > self.slots:
+                dropped += 1
+                continue
+            for fields in records:
+                RECORD.pack_into(self.mem, self._offset(head), *fields)
+                head += 1
+        # publish the records only once they have been written
+        COUNTER.pack_into(self.mem, DROPPED_OFFSET, dropped)
+        COUNTER.pack_into(self.mem, HEAD_OFFSET, head)
+
+
+    def read(self):
+        head, tail, _ = HEADER.unpack_from(self.mem, 0)
+        events = []
+        continued = False
+        for i in range(tail, head):
+            if continued:
+                continued = unpack_continuation(self.mem, self._offset(i), events[-1])
+            else:
+                data, continued = unpack_record(self.mem, self._offset(i))
+                events.append(data)
+        COUNTER.pack_into(self.mem, TAIL_OFFSET, head)
+        return events
+
+
+    @property
+    def dropped(self):
+        return COUNTER.unpack_from(self.mem, DROPPED_OFFSET)[0]
+
+
+def wakeup_fds():
+    if hasattr(os, 'eventfd'):
+        fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        return fd, fd
+    wake_r, wake_w = os.pipe()
+    for fd in [wake_r, wake_w]:
+        os.set_blocking(fd, False)
+    return wake_r, wake_w
+
+
+
+class RingInputListener(InputListener):
+    # InputListener for the capture process: batches are written to the ring
+    # at the end of each wakeup instead of going through the GLib main loop
+    def __init__(self, ring, wake_w, *args, **kwargs):
+        super().__init__(self._ring_write, *args, batch=True, **kwargs)
+        self.ring = ring
+        self.wake_w = wake_w
+
+
+    def _ring_write(self, events):
+        self.ring.write(events)
+        try:
+            os.write(self.wake_w, COUNTER.pack(1))
+        except BlockingIOError:
+            # reader already has a pending wakeup
+            pass
+
+
+    def _event_wakeup(self):
+        pass
+
+
+    def _process(self, r_fd):
+        super()._process(r_fd)
+        self._event_callback()
+
+
+def capture_main(ring, wake_w, args, kwargs):
+    listener = RingInputListener(ring, wake_w, *args, **kwargs)
+    signal.signal(signal.SIGTERM, lambda *_: listener.stop())
+    listener.start()
+    listener.join()
+
+
+
+class ProcessInputListener():
+    # Drop-in replacement for InputListener running the capture in a
+    # separate process. Only the keyboard is supported, as with the ring.
+    def __init__(self, callback, input_types=InputType.keyboard, kbd_compose=True,
+                 kbd_translate=True, kbd_levels=True, batch=False, ring_slots=1024,
+                 kbd_translator='xim', capture='record', devices=None):
+        self.callback = callback
+        self.batch = batch
+        self.args = (input_types, kbd_compose, kbd_translate, kbd_levels)
+        self.kwargs = {'kbd_translator': kbd_translator, 'capture': capture,
+                       'devices': devices}
+        self.ring_slots = ring_slots
+        self.process = None
+        self._source = None
+        self._child_source = None
+
+
+    def start(self):
+        self.ring = EventRing(self.ring_slots)
+        self._wake_r, self._wake_w = wakeup_fds()
+
+        # fork: the mapping and the wakeup fd are inherited as-is
+        ctx = multiprocessing.get_context('fork')
+        self.process = ctx.Process(target=capture_main, daemon=True,
+                                   args=(self.ring, self._wake_w, self.args, self.kwargs))
+        self.process.start()
+        self._source = glib.unix_fd_add_full(glib.PRIORITY_DEFAULT, self._wake_r,
+                                             glib.IOCondition.IN, self._fd_ready)
+
+        # the sentinel becomes readable when the child exits
+        self._child_source = glib.unix_fd_add_full(glib.PRIORITY_DEFAULT, self.process.sentinel,
+                                                   glib.IOCondition.IN | glib.IOCondition.HUP,
+                                                   self._child_exited)
+
+
+    def _unwatch(self):
+        if self._source is not None:
+            glib.source_remove(self._source)
+            self._source = None
+        if self._child_source is not None:
+            glib.source_remove(self._child_source)
+            self._child_source = None
+
+
+    def stop(self):
+        self._unwatch()
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+
+
+    def join(self, timeout=None):
+        if self.process is None:
+            return
+        self.process.join(timeout)
+        if not self.process.is_alive():
+            os.close(self._wake_r)
+            if self._wake_w != self._wake_r:
+                os.close(self._wake_w)
+            self.process = None
+
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+
+    @property
+    def stats(self):
+        return {'dropped': self.ring.dropped}
+
+
+    def _fd_ready(self, fd, condition):
+        try:
+            while os.read(fd, COUNTER.size):
+                pass
+        except BlockingIOError:
+            pass
+        events = self.ring.read()
+        if events:
+            if self.batch:
+                self.callback(events)
+            else:
+                for data in events:
+                    self.callback(data)
+        return True
+
+
+    def _child_exited(self, fd, condition):
+        # the capture died on its own (lost X connection, missing extension):
+        # deliver what it wrote last, then stop watching
+        self._fd_ready(self._wake_r, condition)
+        self.process.join()
+        logger.error("Capture process exited unexpectedly (exit code {})"
+                     .format(self.process.exitcode))
+        self._child_source = None
+        self._unwatch()
+        return False
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# Distributed under the GNU GPLv3+ license, WITHOUT ANY WARRANTY.
+
+# Optional local keyboard translation through libxkbcommon. The keymap is
+# fetched from the X server once (and on MappingNotify), then keysyms and
+# UTF-8 strings are computed in-process from the keycode and the core state
+# of each recorded event, without replaying it to the server. Without an X
+# server the keymap can also be compiled from RMLVO names, tracking the
+# keyboard state from key transitions (see evdevlistener).
+
+from ctypes import *
+import xlib
+
+try:
+    libxkbcommon = CDLL('libxkbcommon.so.0')
+except OSError:
+    libxkbcommon = None
+
+try:
+    libxkbcommon_x11 = CDLL('libxkbcommon-x11.so.0')
+    libX11_xcb = CDLL('libX11-xcb.so.1')
+except OSError:
+    libxkbcommon_x11 = None
+
+
+## xkbcommon
+# types
+class xkb_context(Structure):
+    pass
+
+class xkb_keymap(Structure):
+    pass
+
+class xkb_state(Structure):
+    pass
+
+class xcb_connection_t(Structure):
+    pass
+
+class xkb_rule_names(Structure):
+    _fields_ = [('rules', c_char_p),
+                ('model', c_char_p),
+                ('layout', c_char_p),
+                ('variant', c_char_p),
+                ('options', c_char_p)]
+
+xkb_keycode_t = c_uint32
+xkb_keysym_t = c_uint32
+xkb_mod_mask_t = c_uint32
+xkb_layout_index_t = c_uint32
+
+
+# constants
+XKB_CONTEXT_NO_FLAGS = 0
+XKB_KEYMAP_COMPILE_NO_FLAGS = 0
+XKB_KEY_UP = 0
+XKB_KEY_DOWN = 1
+XKB_STATE_MODS_EFFECTIVE = (1 << 3)
+XKB_STATE_LAYOUT_EFFECTIVE = (1 << 7)
+XKB_X11_MIN_MAJOR_XKB_VERSION = 1
+XKB_X11_MIN_MINOR_XKB_VERSION = 0
+XKB_X11_SETUP_XKB_EXTENSION_NO_FLAGS = 0
+
+
+# functions
+if libxkbcommon is not None:
+    xkb_context_new = libxkbcommon.xkb_context_new
+    xkb_context_new.argtypes = [c_int]
+    xkb_context_new.restype = POINTER(xkb_context)
+
+    xkb_context_unref = libxkbcommon.xkb_context_unref
+    xkb_context_unref.argtypes = [POINTER(xkb_context)]
+    xkb_context_unref.restype = None
+
+    xkb_keymap_unref = libxkbcommon.xkb_keymap_unref
+    xkb_keymap_unref.argtypes = [POINTER(xkb_keymap)]
+    xkb_keymap_unref.restype = None
+
+    xkb_state_new = libxkbcommon.xkb_state_new
+    xkb_state_new.argtypes = [POINTER(xkb_keymap)]
+    xkb_state_new.restype = POINTER(xkb_state)
+
+    xkb_state_unref = libxkbcommon.xkb_state_unref
+    xkb_state_unref.argtypes = [POINTER(xkb_state)]
+    xkb_state_unref.restype = None
+
+    xkb_state_update_mask = libxkbcommon.xkb_state_update_mask
+    xkb_state_update_mask.argtypes = [POINTER(xkb_state), xkb_mod_mask_t, xkb_mod_mask_t,
+                                      xkb_mod_mask_t, xkb_layout_index_t,
+                                      xkb_layout_index_t, xkb_layout_index_t]
+    xkb_state_update_mask.restype = c_int
+
+    xkb_state_key_get_one_sym = libxkbcommon.xkb_state_key_get_one_sym
+    xkb_state_key_get_one_sym.argtypes = [POINTER(xkb_state), xkb_keycode_t]
+    xkb_state_key_get_one_sym.restype = xkb_keysym_t
+
+    xkb_state_key_get_utf8 = libxkbcommon.xkb_state_key_get_utf8
+    xkb_state_key_get_utf8.argtypes = [POINTER(xkb_state), xkb_keycode_t, c_char_p, c_size_t]
+    xkb_state_key_get_utf8.restype = c_int
+
+    xkb_keymap_new_from_names = libxkbcommon.xkb_keymap_new_from_names
+    xkb_keymap_new_from_names.argtypes = [POINTER(xkb_context), POINTER(xkb_rule_names), c_int]
+    xkb_keymap_new_from_names.restype = POINTER(xkb_keymap)
+
+    xkb_keymap_key_get_syms_by_level = libxkbcommon.xkb_keymap_key_get_syms_by_level
+    xkb_keymap_key_get_syms_by_level.argtypes = [POINTER(xkb_keymap), xkb_keycode_t,
+                                                 xkb_layout_index_t, c_uint32,
+                                                 POINTER(POINTER(xkb_keysym_t))]
+    xkb_keymap_key_get_syms_by_level.restype = c_int
+
+    xkb_state_update_key = libxkbcommon.xkb_state_update_key
+    xkb_state_update_key.argtypes = [POINTER(xkb_state), xkb_keycode_t, c_int]
+    xkb_state_update_key.restype = c_int
+
+    xkb_state_serialize_mods = libxkbcommon.xkb_state_serialize_mods
+    xkb_state_serialize_mods.argtypes = [POINTER(xkb_state), c_int]
+    xkb_state_serialize_mods.restype = xkb_mod_mask_t
+
+    xkb_state_serialize_layout = libxkbcommon.xkb_state_serialize_layout
+    xkb_state_serialize_layout.argtypes = [POINTER(xkb_state), c_int]
+    xkb_state_serialize_layout.restype = xkb_layout_index_t
+
+if libxkbcommon_x11 is not None:
+    ## xkbcommon-x11
+    xkb_x11_setup_xkb_extension = libxkbcommon_x11.xkb_x11_setup_xkb_extension
+    xkb_x11_setup_xkb_extension.argtypes = [POINTER(xcb_connection_t), c_uint16, c_uint16, c_int,
+                                            POINTER(c_uint16), POINTER(c_uint16),
+                                            POINTER(c_uint8), POINTER(c_uint8)]
+    xkb_x11_setup_xkb_extension.restype = c_int
+
+    xkb_x11_get_core_keyboard_device_id = libxkbcommon_x11.xkb_x11_get_core_keyboard_device_id
+    xkb_x11_get_core_keyboard_device_id.argtypes = [POINTER(xcb_connection_t)]
+    xkb_x11_get_core_keyboard_device_id.restype = c_int32
+
+    xkb_x11_keymap_new_from_device = libxkbcommon_x11.xkb_x11_keymap_new_from_device
+    xkb_x11_keymap_new_from_device.argtypes = [POINTER(xkb_context), POINTER(xcb_connection_t),
+                                               c_int32, c_int]
+    xkb_x11_keymap_new_from_device.restype = POINTER(xkb_keymap)
+
+    ## X11-xcb
+    XGetXCBConnection = libX11_xcb.XGetXCBConnection
+    XGetXCBConnection.argtypes = [POINTER(xlib.Display)]
+    XGetXCBConnection.restype = POINTER(xcb_connection_t)
+
+
+
+class XkbKeymap():
+    def __init__(self):
+        if libxkbcommon is None:
+            raise Exception("libxkbcommon is not available")
+        self.ctx = xkb_context_new(XKB_CONTEXT_NO_FLAGS)
+        self.buf = create_string_buffer(64)
+        self.syms = POINTER(xkb_keysym_t)()
+        self.keymap = None
+        self.state = None
+
+
+    def _set_keymap(self, keymap):
+        if not keymap:
+            raise Exception("Cannot compile the keyboard map")
+        self._unref()
+        self.keymap = keymap
+        self.state = xkb_state_new(keymap)
+
+
+    def key_get(self, keycode):
+        keysym = xkb_state_key_get_one_sym(self.state, keycode)
+        string = None
+        if xkb_state_key_get_utf8(self.state, keycode, self.buf, len(self.buf)) > 0:
+            string = self.buf.value.decode('utf-8', 'replace')
+        return keysym, string
+
+
+    def key_get_base(self, keycode):
+        # first level of the current layout, ignoring modifiers
+        layout = xkb_state_serialize_layout(self.state, XKB_STATE_LAYOUT_EFFECTIVE)
+        if xkb_keymap_key_get_syms_by_level(self.keymap, keycode, layout, 0,
+                                            byref(self.syms)) < 1:
+            return 0
+        return self.syms[0]
+
+
+    def _unref(self):
+        if self.state:
+            xkb_state_unref(self.state)
+        if self.keymap:
+            xkb_keymap_unref(self.keymap)
+        self.keymap = self.state = None
+
+
+    def close(self):
+        self._unref()
+        xkb_context_unref(self.ctx)
+
+
+
+class XkbTranslator(XkbKeymap):
+    # The modifier/group state is taken from the core state of each event
+    # (real modifiers keep their X11 indices in keymaps fetched from the
+    # server), so no key tracking is needed and events can be translated
+    # independently of each other.
+    def __init__(self, dpy):
+        super().__init__()
+        if libxkbcommon_x11 is None:
+            raise Exception("libxkbcommon-x11 is not available")
+        self.conn = XGetXCBConnection(dpy)
+        if not xkb_x11_setup_xkb_extension(self.conn,
+                                           XKB_X11_MIN_MAJOR_XKB_VERSION,
+                                           XKB_X11_MIN_MINOR_XKB_VERSION,
+                                           XKB_X11_SETUP_XKB_EXTENSION_NO_FLAGS,
+                                           None, None, None, None):
+            raise Exception("Cannot initialize the XKB extension")
+        self.device = xkb_x11_get_core_keyboard_device_id(self.conn)
+        self.reload()
+
+
+    def reload(self):
+        self._set_keymap(xkb_x11_keymap_new_from_device(self.ctx, self.conn, self.device,
+                                                        XKB_KEYMAP_COMPILE_NO_FLAGS))
+
+
+    def lookup(self, keycode, state):
+        xkb_state_update_mask(self.state, state & 0xff, 0, 0, 0, 0, (state >> 13) & 3)
+        return self.key_get(keycode)
+
+
+
+class XkbKeyboard(XkbKeymap):
+    # Keymap compiled from RMLVO names (empty fields are taken from the
+    # XKB_DEFAULT_* environment or the system defaults), with the state
+    # tracked from the key transitions of all devices together, like the
+    # X server does for the core keyboard.
+    def __init__(self, rules=None, model=None, layout=None, variant=None, options=None):
+        super().__init__()
+        names = xkb_rule_names(*[value.encode() if value else None
+                                 for value in [rules, model, layout, variant, options]])
+        self._set_keymap(xkb_keymap_new_from_names(self.ctx, byref(names),
+                                                   XKB_KEYMAP_COMPILE_NO_FLAGS))
+
+
+    def reset(self):
+        # state lost (dropped events): start again with no keys held
+        xkb_state_unref(self.state)
+        self.state = xkb_state_new(self.keymap)
+
+
+    def update(self, keycode, pressed):
+        xkb_state_update_key(self.state, keycode, XKB_KEY_DOWN if pressed else XKB_KEY_UP)
+
+
+    def core_state(self):
+        # the first 8 modifiers are always the real ones, in X11 order
+        mods = xkb_state_serialize_mods(self.state, XKB_STATE_MODS_EFFECTIVE)
+        layout = xkb_state_serialize_layout(self.state, XKB_STATE_LAYOUT_EFFECTIVE)
+        return ((layout & 0x3) << 13) | (mods & 0xff)
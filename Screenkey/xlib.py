@@ -4,6 +4,8 @@
 
 from __future__ import unicode_literals
 from ctypes import *
+from collections import namedtuple
+from struct import Struct
 
 ## base X11
 libX11 = CDLL('libX11.so.6')
@@ -92,12 +94,34 @@ class XClientMessageEvent(Structure):
                 ('format', c_int),
                 ('data', c_long * 5)]
 
+class XMappingEvent(Structure):
+    _fields_ = [('type', c_int),
+                ('serial', c_ulong),
+                ('send_event', Bool),
+                ('display', POINTER(Display)),
+                ('window', Window),
+                ('request', c_int),
+                ('first_keycode', c_int),
+                ('count', c_int)]
+
+class XGenericEventCookie(Structure):
+    _fields_ = [('type', c_int),
+                ('serial', c_ulong),
+                ('send_event', Bool),
+                ('display', POINTER(Display)),
+                ('extension', c_int),
+                ('evtype', c_int),
+                ('cookie', c_uint),
+                ('data', c_void_p)]
+
 class XEvent(Union):
     _fields_ = [('type', c_int),
                 ('xkey', XKeyEvent),
                 ('xbutton', XButtonEvent),
                 ('xmotion', XMotionEvent),
                 ('xclient', XClientMessageEvent),
+                ('xmapping', XMappingEvent),
+                ('xcookie', XGenericEventCookie),
                 ('pad', c_long * 24)]
 
 class XSetWindowAttributes(Structure):
@@ -127,12 +151,27 @@ MotionNotify = 6
 FocusIn = 9
 FocusOut = 10
 ClientMessage = 33
+MappingNotify = 34
+GenericEvent = 35
+
+NotifyAncestor = 0
+NotifyVirtual = 1
+NotifyInferior = 2
+NotifyNonlinear = 3
+NotifyNonlinearVirtual = 4
+NotifyPointer = 5
+NotifyPointerRoot = 6
+NotifyDetailNone = 7
 
 CopyFromParent = 0
 InputOnly = 2
 
 CWOverrideRedirect = (1<<9)
 
+QueuedAlready = 0
+QueuedAfterReading = 1
+QueuedAfterFlush = 2
+
 ShiftMask = (1<<0)
 LockMask = (1<<1)
 ControlMask = (1<<2)
@@ -196,10 +235,26 @@ XPending = libX11.XPending
 XPending.argtypes = [POINTER(Display)]
 XPending.restype = c_int
 
+XEventsQueued = libX11.XEventsQueued
+XEventsQueued.argtypes = [POINTER(Display), c_int]
+XEventsQueued.restype = c_int
+
 XSynchronize = libX11.XSynchronize
 XSynchronize.argtypes = [POINTER(Display), c_int]
 XSynchronize.restype = POINTER(CFUNCTYPE(c_int, POINTER(Display)))
 
+XQueryExtension = libX11.XQueryExtension
+XQueryExtension.argtypes = [POINTER(Display), String, POINTER(c_int), POINTER(c_int), POINTER(c_int)]
+XQueryExtension.restype = Bool
+
+XGetEventData = libX11.XGetEventData
+XGetEventData.argtypes = [POINTER(Display), POINTER(XGenericEventCookie)]
+XGetEventData.restype = Bool
+
+XFreeEventData = libX11.XFreeEventData
+XFreeEventData.argtypes = [POINTER(Display), POINTER(XGenericEventCookie)]
+XFreeEventData.restype = None
+
 
 ## xim
 # types
@@ -218,11 +273,39 @@ class _XrmDatabase(Structure):
 
 XrmDatabase = POINTER(_XrmDatabase)
 
+XIMFeedback = c_ulong
+
+# callbacks receive the XIC, client data and call data as plain addresses
+XICProc = CFUNCTYPE(c_int, c_void_p, c_void_p, c_void_p)
+XIMProc = CFUNCTYPE(None, c_void_p, c_void_p, c_void_p)
+
+class XIMCallback(Structure):
+    _fields_ = [('client_data', c_void_p),
+                ('callback', c_void_p)]
+
+class XIMText(Structure):
+    _fields_ = [('length', c_ushort),
+                ('feedback', POINTER(XIMFeedback)),
+                ('encoding_is_wchar', Bool),
+                ('string', c_void_p)]
+
+class XIMPreeditDrawCallbackStruct(Structure):
+    _fields_ = [('caret', c_int),
+                ('chg_first', c_int),
+                ('chg_length', c_int),
+                ('text', POINTER(XIMText))]
+
 
 # constants
 XNInputStyle = b'inputStyle'
 XNClientWindow = b'clientWindow'
+XNPreeditAttributes = b'preeditAttributes'
+XNPreeditStartCallback = b'preeditStartCallback'
+XNPreeditDoneCallback = b'preeditDoneCallback'
+XNPreeditDrawCallback = b'preeditDrawCallback'
+XNPreeditCaretCallback = b'preeditCaretCallback'
 
+XIMPreeditCallbacks = 0x0002
 XIMPreeditNothing = 0x0008
 XIMPreeditNone = 0x0010
 XIMStatusNothing = 0x0400
@@ -252,6 +335,9 @@ XCloseIM.restype = c_int
 XCreateIC = libX11.XCreateIC
 XCreateIC.restype = XIC
 
+XVaCreateNestedList = libX11.XVaCreateNestedList
+XVaCreateNestedList.restype = c_void_p
+
 XDestroyIC = libX11.XDestroyIC
 XDestroyIC.argtypes = [XIC]
 XDestroyIC.restype = None
@@ -260,6 +346,10 @@ XSetICFocus = libX11.XSetICFocus
 XSetICFocus.argtypes = [XIC]
 XSetICFocus.restype = None
 
+XUnsetICFocus = libX11.XUnsetICFocus
+XUnsetICFocus.argtypes = [XIC]
+XUnsetICFocus.restype = None
+
 Xutf8ResetIC = libX11.Xutf8ResetIC
 Xutf8ResetIC.argtypes = [XIC]
 Xutf8ResetIC.restype = String
@@ -272,6 +362,18 @@ XKeysymToString = libX11.XKeysymToString
 XKeysymToString.argtypes = [KeySym]
 XKeysymToString.restype = String
 
+XStringToKeysym = libX11.XStringToKeysym
+XStringToKeysym.argtypes = [String]
+XStringToKeysym.restype = KeySym
+
+XDisplayKeycodes = libX11.XDisplayKeycodes
+XDisplayKeycodes.argtypes = [POINTER(Display), POINTER(c_int), POINTER(c_int)]
+XDisplayKeycodes.restype = c_int
+
+XRefreshKeyboardMapping = libX11.XRefreshKeyboardMapping
+XRefreshKeyboardMapping.argtypes = [POINTER(XMappingEvent)]
+XRefreshKeyboardMapping.restype = c_int
+
 XkbKeycodeToKeysym = libX11.XkbKeycodeToKeysym
 XkbKeycodeToKeysym.argtypes = [POINTER(Display), KeyCode, c_uint, c_uint]
 XkbKeycodeToKeysym.restype = KeySym
@@ -354,6 +456,140 @@ XRecordFreeData.argtypes = [POINTER(XRecordInterceptData)]
 XRecordFreeData.restype = None
 
 
+## xkb
+# types
+class XkbStateRec(Structure):
+    _fields_ = [('group', c_ubyte),
+                ('locked_group', c_ubyte),
+                ('base_group', c_ushort),
+                ('latched_group', c_ushort),
+                ('mods', c_ubyte),
+                ('base_mods', c_ubyte),
+                ('latched_mods', c_ubyte),
+                ('locked_mods', c_ubyte),
+                ('compat_state', c_ubyte),
+                ('grab_mods', c_ubyte),
+                ('compat_grab_mods', c_ubyte),
+                ('lookup_mods', c_ubyte),
+                ('compat_lookup_mods', c_ubyte),
+                ('ptr_buttons', c_ushort)]
+
+class XkbStateNotifyEvent(Structure):
+    _fields_ = [('type', c_int),
+                ('serial', c_ulong),
+                ('send_event', Bool),
+                ('display', POINTER(Display)),
+                ('time', Time),
+                ('xkb_type', c_int),
+                ('device', c_int),
+                ('changed', c_uint),
+                ('group', c_int),
+                ('base_group', c_int),
+                ('latched_group', c_int),
+                ('locked_group', c_int),
+                ('mods', c_uint),
+                ('base_mods', c_uint),
+                ('latched_mods', c_uint),
+                ('locked_mods', c_uint),
+                ('compat_state', c_int),
+                ('grab_mods', c_ubyte),
+                ('compat_grab_mods', c_ubyte),
+                ('lookup_mods', c_ubyte),
+                ('compat_lookup_mods', c_ubyte),
+                ('ptr_buttons', c_int),
+                ('keycode', KeyCode),
+                ('event_type', c_char),
+                ('req_major', c_char),
+                ('req_minor', c_char)]
+
+
+# constants
+XkbUseCoreKbd = 0x0100
+XkbStateNotify = 2
+XkbAllStateComponentsMask = 0x3fff
+
+def XkbBuildCoreState(mods, group):
+    return ((group & 0x3) << 13) | (mods & 0xff)
+
+
+# functions
+XkbQueryExtension = libX11.XkbQueryExtension
+XkbQueryExtension.argtypes = [POINTER(Display), POINTER(c_int), POINTER(c_int), POINTER(c_int), POINTER(c_int), POINTER(c_int)]
+XkbQueryExtension.restype = Bool
+
+XkbGetState = libX11.XkbGetState
+XkbGetState.argtypes = [POINTER(Display), c_uint, POINTER(XkbStateRec)]
+XkbGetState.restype = Status
+
+XkbSelectEventDetails = libX11.XkbSelectEventDetails
+XkbSelectEventDetails.argtypes = [POINTER(Display), c_uint, c_uint, c_ulong, c_ulong]
+XkbSelectEventDetails.restype = Bool
+
+
+## xinput2 (optional, only needed by the xi2 capture)
+try:
+    libXi = CDLL('libXi.so.6')
+except OSError:
+    libXi = None
+
+# types
+class XIEventMask(Structure):
+    _fields_ = [('deviceid', c_int),
+                ('mask_len', c_int),
+                ('mask', POINTER(c_ubyte))]
+
+class XIValuatorState(Structure):
+    _fields_ = [('mask_len', c_int),
+                ('mask', POINTER(c_ubyte)),
+                ('values', POINTER(c_double))]
+
+class XIRawEvent(Structure):
+    _fields_ = [('type', c_int),
+                ('serial', c_ulong),
+                ('send_event', Bool),
+                ('display', POINTER(Display)),
+                ('extension', c_int),
+                ('evtype', c_int),
+                ('time', Time),
+                ('deviceid', c_int),
+                ('sourceid', c_int),
+                ('detail', c_int),
+                ('flags', c_int),
+                ('valuators', XIValuatorState),
+                ('raw_values', POINTER(c_double))]
+
+
+# constants
+XIAllDevices = 0
+XIAllMasterDevices = 1
+
+XI_RawKeyPress = 13
+XI_RawKeyRelease = 14
+XI_RawButtonPress = 15
+XI_RawButtonRelease = 16
+XI_RawMotion = 17
+XI_LASTEVENT = 26
+
+XIKeyRepeat = (1 << 16)
+
+def XIMaskLen(event):
+    return (event >> 3) + 1
+
+def XISetMask(mask, event):
+    mask[event >> 3] |= (1 << (event & 7))
+
+
+# functions
+if libXi is not None:
+    XIQueryVersion = libXi.XIQueryVersion
+    XIQueryVersion.argtypes = [POINTER(Display), POINTER(c_int), POINTER(c_int)]
+    XIQueryVersion.restype = Status
+
+    XISelectEvents = libXi.XISelectEvents
+    XISelectEvents.argtypes = [POINTER(Display), Window, POINTER(XIEventMask), c_int]
+    XISelectEvents.restype = c_int
+
+
 ## wire protocol
 CARD8 = c_ubyte
 CARD16 = c_ushort
@@ -385,74 +621,41 @@ class xEvent(Union):
     _fields_ = [('u', xEventType),
                 ('keyButtonPointer', xKeyButtonPointer)]
 
+sz_xEvent = 32
 
-def _kbd_wire_to_event(dpy, wev):
-    ev = XEvent()
-    ev.xkey.type = wev.u.type
-    ev.xkey.serial = wev.u.sequenceNumber
-    ev.xkey.send_event = ((wev.u.type & 0x80) != 0)
-    ev.xkey.display = dpy
-    ev.xkey.window = wev.keyButtonPointer.event
-    ev.xkey.root = wev.keyButtonPointer.root
-    ev.xkey.subwindow = wev.keyButtonPointer.child
-    ev.xkey.time = wev.keyButtonPointer.time
-    ev.xkey.x = wev.keyButtonPointer.eventX
-    ev.xkey.y = wev.keyButtonPointer.eventY
-    ev.xkey.x_root = wev.keyButtonPointer.rootX
-    ev.xkey.y_root = wev.keyButtonPointer.rootY
-    ev.xkey.state = wev.keyButtonPointer.state
-    ev.xkey.keycode = wev.u.detail
-    ev.xkey.same_screen = wev.keyButtonPointer.sameScreen
-    return ev
 
+# struct-based wire decoding: a single unpack per event instead of one ctypes
+# access per field, producing a plain tuple until an XEvent is really needed
+_wire_struct = Struct('=BBHIIIIhhhhHBx')
+_xkey_struct = Struct('@iLiPLLLLiiiiIIi')
+_xmotion_struct = Struct('@iLiPLLLLiiiiIBi')
+_xany_struct = Struct('@i')
 
-def _btn_wire_to_event(dpy, wev):
-    ev = XEvent()
-    ev.xbutton.type = wev.u.type
-    ev.xbutton.serial = wev.u.sequenceNumber
-    ev.xbutton.send_event = ((wev.u.type & 0x80) != 0)
-    ev.xbutton.display = dpy
-    ev.xbutton.window = wev.keyButtonPointer.event
-    ev.xbutton.root = wev.keyButtonPointer.root
-    ev.xbutton.subwindow = wev.keyButtonPointer.child
-    ev.xbutton.time = wev.keyButtonPointer.time
-    ev.xbutton.x = wev.keyButtonPointer.eventX
-    ev.xbutton.y = wev.keyButtonPointer.eventY
-    ev.xbutton.x_root = wev.keyButtonPointer.rootX
-    ev.xbutton.y_root = wev.keyButtonPointer.rootY
-    ev.xbutton.state = wev.keyButtonPointer.state
-    ev.xbutton.button = wev.u.detail
-    ev.xbutton.same_screen = wev.keyButtonPointer.sameScreen
-    return ev
+WireEvent = namedtuple('WireEvent', ['type', 'detail', 'sequence', 'time',
+                                     'root', 'event', 'child', 'root_x', 'root_y',
+                                     'event_x', 'event_y', 'state', 'same_screen'])
 
 
-def _mtn_wire_to_event(dpy, wev):
-    ev = XEvent()
-    ev.xmotion.type = wev.u.type
-    ev.xmotion.serial = wev.u.sequenceNumber
-    ev.xmotion.send_event = ((wev.u.type & 0x80) != 0)
-    ev.xmotion.display = dpy
-    ev.xmotion.window = wev.keyButtonPointer.event
-    ev.xmotion.root = wev.keyButtonPointer.root
-    ev.xmotion.subwindow = wev.keyButtonPointer.child
-    ev.xmotion.time = wev.keyButtonPointer.time
-    ev.xmotion.x = wev.keyButtonPointer.eventX
-    ev.xmotion.y = wev.keyButtonPointer.eventY
-    ev.xmotion.x_root = wev.keyButtonPointer.rootX
-    ev.xmotion.y_root = wev.keyButtonPointer.rootY
-    ev.xmotion.state = wev.keyButtonPointer.state
-    ev.xmotion.is_hint = wev.u.detail
-    ev.xmotion.same_screen = wev.keyButtonPointer.sameScreen
-    return ev
+def XWireEvents(data):
+    # decode all the events contained in a buffer of wire data
+    length = len(data) - len(data) % sz_xEvent
+    return [WireEvent._make(t) for t in _wire_struct.iter_unpack(data[:length])]
 
 
-def XWireToEvent(dpy, data):
+def XWireToEvent(dpy, wev, ev):
     # this could have been avoided if _XWireToEvent didn't have internal state
-    wev = cast(data, POINTER(xEvent)).contents
-    if wev.u.type in [KeyPress, KeyRelease]:
-        return _kbd_wire_to_event(dpy, wev)
-    elif wev.u.type in [ButtonPress, ButtonRelease]:
-        return _btn_wire_to_event(dpy, wev)
-    elif wev.u.type == MotionNotify:
-        return _mtn_wire_to_event(dpy, wev)
-    return XEvent(wev.u.type)
+    # dpy is the address of the display, ev a writable buffer for an XEvent
+    ev_type = wev.type & 0x7f
+    if ev_type in [KeyPress, KeyRelease, ButtonPress, ButtonRelease]:
+        # XKeyEvent and XButtonEvent share the same layout
+        fmt = _xkey_struct
+    elif ev_type == MotionNotify:
+        fmt = _xmotion_struct
+    else:
+        _xany_struct.pack_into(ev, 0, ev_type)
+        return ev
+    fmt.pack_into(ev, 0, ev_type, wev.sequence, wev.type >> 7, dpy,
+                  wev.event, wev.root, wev.child, wev.time,
+                  wev.event_x, wev.event_y, wev.root_x, wev.root_y,
+                  wev.state, wev.detail, wev.same_screen)
+    return ev
@@ -0,0 +1,95 @@
+# The modules are imported from the Screenkey directory, as done by the
+# screenkey script. Neither an X server nor GObject are required: GLib is
+# replaced by a stub recording its sources when missing, and X libraries
+# which cannot be loaded are replaced by libraries whose functions need to be
+# patched by the tests before being called.
+
+import ctypes
+import html
+import itertools
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'Screenkey'))
+
+
+class StubFunction():
+    def __init__(self, name):
+        self.name = name
+        self.argtypes = None
+        self.restype = None
+
+    def __call__(self, *args):
+        raise NotImplementedError("{} is not available here".format(self.name))
+
+
+class StubLibrary():
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        func = StubFunction(name)
+        setattr(self, name, func)
+        return func
+
+
+class IOCondition:
+    IN   = 1
+    PRI  = 2
+    OUT  = 4
+    ERR  = 8
+    HUP  = 16
+    NVAL = 32
+
+
+def stub_glib():
+    glib = types.ModuleType('gi.repository.GLib')
+    glib.PRIORITY_DEFAULT = 0
+    glib.IOCondition = IOCondition
+    glib.sources = {}
+    ids = itertools.count(1)
+
+    def add(*source):
+        tag = next(ids)
+        glib.sources[tag] = source
+        return tag
+
+    glib.idle_add = lambda func, *args: add('idle', func, args)
+    glib.timeout_add = lambda interval, func, *args: add('timeout', func, args, interval)
+    glib.unix_fd_add_full = lambda priority, fd, condition, func, *args: \
+        add('fd', func, args, fd, condition)
+    glib.source_remove = lambda tag: glib.sources.pop(tag) is not None
+    glib.markup_escape_text = lambda text, *args: html.escape(text, quote=False)
+    glib.threads_init = lambda: None
+    return glib
+
+
+try:
+    import gi
+except ImportError:
+    gi = types.ModuleType('gi')
+    gi.require_version = lambda name, version: None
+    gi.repository = types.ModuleType('gi.repository')
+    gi.repository.GLib = stub_glib()
+    sys.modules.update({'gi': gi, 'gi.repository': gi.repository,
+                        'gi.repository.GLib': gi.repository.GLib})
+
+
+def _load(cdll):
+    def load(name, *args, **kwargs):
+        try:
+            return cdll(name, *args, **kwargs)
+        except OSError:
+            return StubLibrary(name)
+    return load
+
+# only libX11 is required to load xlib for real (keysym names)
+_cdll, ctypes.CDLL = ctypes.CDLL, _load(ctypes.CDLL)
+try:
+    import xlib
+finally:
+    ctypes.CDLL = _cdll
@@ -0,0 +1,141 @@
+# Fake keyboard and X connections shared by the listener tests: keymaps are
+# defined by KEYMAP, recorded events are produced as raw wire data.
+
+import xlib
+from inputlistener import KEYMAP_GROUPS, KEYMAP_LEVELS, InputType
+from evdevlistener import EvdevInputListener
+
+# keycode: (level 1, level 2) keysyms, keycodes are the X ones
+KEYMAP = {
+    24: (0x71, 0x51),           # q Q
+    36: (0xff0d, 0xff0d),       # Return
+    37: (0xffe3, 0xffe3),       # Control_L
+    38: (0x61, 0x41),           # a A
+    50: (0xffe1, 0xffe1),       # Shift_L
+    51: (0xfe51, 0xfe51),       # dead_acute
+    65: (0x20, 0x20),           # space
+}
+
+MODIFIERS = {37: xlib.ControlMask, 50: xlib.ShiftMask}
+
+
+def keymap_table():
+    table = [xlib.NoSymbol] * (256 * KEYMAP_GROUPS * KEYMAP_LEVELS)
+    for keycode, keysyms in KEYMAP.items():
+        base = keycode * KEYMAP_GROUPS * KEYMAP_LEVELS
+        table[base:base + len(keysyms)] = keysyms
+    return table
+
+
+def key_get(keycode, state):
+    keysyms = KEYMAP.get(keycode, (0, 0))
+    keysym = keysyms[1 if state & xlib.ShiftMask else 0]
+    string = None
+    if keysym == 0xff0d:
+        string = '\r'
+    elif keysym < 0x100:
+        string = chr(keysym)
+    return keysym, string
+
+
+class FakeTranslator():
+    # stands for xkb.XkbTranslator
+    def lookup(self, keycode, state):
+        return key_get(keycode, state)
+
+    def reload(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeKeyboard():
+    # stands for xkb.XkbKeyboard, tracking the modifiers of KEYMAP
+    def __init__(self):
+        self.state = 0
+
+    def reset(self):
+        self.state = 0
+
+    def update(self, keycode, pressed):
+        mask = MODIFIERS.get(keycode, 0)
+        if pressed:
+            self.state |= mask
+        else:
+            self.state &= ~mask
+
+    def core_state(self):
+        return self.state
+
+    def key_get(self, keycode):
+        return key_get(keycode, self.state)
+
+    def key_get_base(self, keycode):
+        return key_get(keycode, 0)[0]
+
+    def close(self):
+        pass
+
+
+def wire(ev_type, keycode, state=0, time=0, window=0):
+    # key event as sent by the server (and recorded by XRecord)
+    return xlib._wire_struct.pack(ev_type, keycode, 0, time, 1, window, 0,
+                                  0, 0, 0, 0, state, 1)
+
+
+class FakeRecord():
+    # XRecord data connection: the intercept runs (and queues the decoded
+    # events) whenever Xlib reads the replies, which libXtst does in
+    # XRecordProcessReplies as well as in XPending, and never reports events
+    def __init__(self, listener):
+        self.listener = listener
+        self.replies = []
+        self.reads = 0
+
+    def read(self, dpy):
+        if dpy == 'capture':
+            self.reads += 1
+            while self.replies:
+                self.listener._event_received(self.replies.pop(0))
+        return 0
+
+
+def record_setup(listener, monkeypatch):
+    # listener as left by _setup with the record capture and the xkb
+    # translator, over fake connections
+    listener.capture_dpy = 'capture'
+    listener.replay_dpy = 'replay'
+    listener.capture_fd = -2
+    listener.replay_fd = -3
+    listener._kbd_last = None
+    listener._kbd_keymap = keymap_table()
+    listener._kbd_xkb = FakeTranslator()
+    listener._kbd_composer = None
+    listener.stopped = False
+
+    record = FakeRecord(listener)
+    monkeypatch.setattr(xlib, 'XPending', record.read)
+    monkeypatch.setattr(xlib, 'XRecordProcessReplies', record.read)
+    monkeypatch.setattr(xlib, 'XEventsQueued', lambda dpy, mode: 0)
+    monkeypatch.setattr(xlib, 'XFlush', lambda dpy: 0)
+    return record
+
+
+def record_listener(cls, monkeypatch, callback, *args, **kwargs):
+    kwargs.setdefault('kbd_translator', 'xkb')
+    listener = cls(callback, InputType.keyboard, *args, **kwargs)
+    return listener, record_setup(listener, monkeypatch)
+
+
+def evdev_setup(listener):
+    # listener as left by start, without devices
+    listener.stopped = False
+    listener.keyboard = FakeKeyboard()
+    listener.composer = None
+
+
+def evdev_listener(callback, *args, **kwargs):
+    listener = EvdevInputListener(callback, InputType.keyboard, *args, **kwargs)
+    evdev_setup(listener)
+    return listener
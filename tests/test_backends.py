@@ -0,0 +1,143 @@
+# Conformance of the capture backends: the same key script is replayed
+# through each of them in its native form (recorded wire events, raw XInput2
+# events with XKB state, evdev codes), and must produce the same KeyData.
+
+import xlib
+import xkb
+import backends
+from backends import Capability
+from evdevlistener import EVDEV_OFFSET, KEY_PRESS, KEY_RELEASE, KEY_REPEAT
+
+from collections import namedtuple
+import pytest
+
+import fakes
+
+
+RawEvent = namedtuple('RawEvent', ['evtype', 'detail', 'sourceid', 'time'])
+
+# (X keycode, action)
+SCRIPT = [
+    (38, 'press'), (38, 'release'),                             # a
+    (50, 'press'), (38, 'press'), (38, 'repeat'), (38, 'repeat'),
+    (38, 'release'), (50, 'release'),                           # Shift+A, held
+    (37, 'press'), (24, 'press'), (24, 'release'), (37, 'release'),  # Ctrl+q
+    (65, 'press'), (65, 'release'), (36, 'press'), (36, 'release'),
+]
+
+FIELDS = ('pressed', 'repeated', 'filtered', 'keysym', 'string', 'symbol', 'mods_mask',
+          'count')
+
+
+def script_states():
+    # core state before each event of the script
+    state = 0
+    for keycode, action in SCRIPT:
+        yield keycode, action, state
+        mask = fakes.MODIFIERS.get(keycode, 0)
+        if action == 'press':
+            state |= mask
+        elif action == 'release':
+            state &= ~mask
+
+
+def replay_record(listener, monkeypatch):
+    record = fakes.record_setup(listener, monkeypatch)
+    data = b''
+    for time, (keycode, action, state) in enumerate(script_states()):
+        if action == 'repeat':
+            # server auto-repeat: release/press pairs sharing the same time
+            data += fakes.wire(xlib.KeyRelease, keycode, state, time)
+            action = 'press'
+        ev_type = xlib.KeyPress if action == 'press' else xlib.KeyRelease
+        data += fakes.wire(ev_type, keycode, state, time)
+    record.replies.append(data)
+    listener._process(listener._ready_fds())
+    listener._event_callback()
+
+
+def replay_xi2(listener, monkeypatch):
+    fakes.record_setup(listener, monkeypatch)
+    listener._xi2_root = 1
+    for time, (keycode, action, state) in enumerate(script_states()):
+        if action == 'repeat':
+            # auto-repeat produces no raw events
+            continue
+        # the state follows from XkbStateNotify, sent after the raw event
+        listener._xi2_state = state
+        evtype = xlib.XI_RawKeyRelease if action == 'release' else xlib.XI_RawKeyPress
+        listener._xi2_event(RawEvent(evtype, keycode, 3, time))
+    listener._event_flush()
+    listener._event_callback()
+
+
+def replay_evdev(listener, monkeypatch):
+    fakes.evdev_setup(listener)
+    values = {'press': KEY_PRESS, 'release': KEY_RELEASE, 'repeat': KEY_REPEAT}
+    for keycode, action in SCRIPT:
+        listener._key_event(keycode - EVDEV_OFFSET, values[action])
+    listener._event_callback()
+
+
+REPLAY = {'record': replay_record, 'xi2': replay_xi2, 'evdev': replay_evdev}
+
+
+def replay(name, monkeypatch):
+    events = []
+    listener = backends.create(name, events.extend, batch=True, translator='xkb')
+    # delivery from the main loop, which the tests stand for
+    monkeypatch.setattr(listener, '_event_wakeup', lambda: None)
+    assert listener.backend == name
+    REPLAY[name](listener, monkeypatch)
+    return [tuple(getattr(data, field) for field in FIELDS) for data in events]
+
+
+def test_all_backends_are_covered():
+    assert set(REPLAY) == set(backends.BACKENDS)
+
+
+@pytest.mark.parametrize('name', sorted(REPLAY))
+def test_backend_conformance(name, monkeypatch):
+    expected = replay('evdev', monkeypatch)
+    # the auto-repeats are coalesced by the queue
+    assert [event[:2] + event[4:6] + event[7:] for event in expected] == [
+        (True, False, 'a', 'a', 1), (False, False, 'a', 'a', 1),
+        (True, False, None, 'Shift_L', 1), (True, False, 'A', 'A', 1),
+        (True, True, 'A', 'A', 2),
+        (False, False, 'A', 'A', 1), (False, False, None, 'Shift_L', 1),
+        (True, False, None, 'Control_L', 1), (True, False, 'q', 'q', 1),
+        (False, False, 'q', 'q', 1), (False, False, None, 'Control_L', 1),
+        (True, False, ' ', 'space', 1), (False, False, ' ', 'space', 1),
+        (True, False, '\r', 'Return', 1), (False, False, '\r', 'Return', 1),
+    ]
+    if Capability.repeats not in backends.get(name).capabilities:
+        # a held key is a single press
+        expected = [event for event in expected if not event[1]]
+    assert replay(name, monkeypatch) == expected
+
+
+@pytest.mark.parametrize('name', sorted(REPLAY))
+def test_capabilities(name):
+    capabilities = backends.get(name).capabilities
+    assert Capability.translates in capabilities
+    assert Capability.composes in capabilities
+
+
+def test_evdev_requires_libxkbcommon(monkeypatch):
+    monkeypatch.setattr(backends.os, 'listdir', lambda path: ['event0'])
+    monkeypatch.setattr(backends.os, 'access', lambda path, mode: True)
+    assert backends.evdev_available()
+    monkeypatch.setattr(xkb, 'libxkbcommon', None)
+    assert not backends.evdev_available()
+
+
+def test_detect_prefers_evdev_under_wayland(monkeypatch):
+    monkeypatch.setenv('WAYLAND_DISPLAY', 'wayland-0')
+    monkeypatch.setitem(backends.BACKENDS, 'record',
+                        backends.BACKENDS['record']._replace(available=lambda: True))
+    monkeypatch.setitem(backends.BACKENDS, 'evdev',
+                        backends.BACKENDS['evdev']._replace(available=lambda: True))
+    assert backends.detect().name == 'evdev'
+    monkeypatch.setitem(backends.BACKENDS, 'evdev',
+                        backends.BACKENDS['evdev']._replace(available=lambda: False))
+    assert backends.detect().name == 'record'
@@ -0,0 +1,89 @@
+from evdevlistener import INPUT_EVENT, EV_KEY, EV_SYN, SYN_DROPPED, EVDEV_OFFSET
+import compose
+
+from gi.repository import GLib as glib
+
+import os
+import pytest
+
+import fakes
+
+
+def input_events(*events):
+    # packed input_event structs, keycodes are the X ones
+    data = b''
+    for ev_type, code, value in events:
+        if ev_type == EV_KEY:
+            code -= EVDEV_OFFSET
+        data += INPUT_EVENT.pack(0, 0, ev_type, code, value)
+        data += INPUT_EVENT.pack(0, 0, EV_SYN, 0, 0)
+    return data
+
+
+@pytest.fixture
+def device():
+    fd_r, fd_w = os.pipe()
+    os.set_blocking(fd_r, False)
+    yield fd_r, fd_w
+    os.close(fd_r)
+    os.close(fd_w)
+
+
+def ready(listener, fd, name='event3'):
+    listener._devs[name] = (fd, None)
+    return listener._device_ready(fd, glib.IOCondition.IN, name)
+
+
+def test_device_events_are_delivered(device):
+    fd_r, fd_w = device
+    events = []
+    listener = fakes.evdev_listener(events.extend, batch=True)
+    os.write(fd_w, input_events((EV_KEY, 50, 1), (EV_KEY, 38, 1), (EV_KEY, 38, 2),
+                                (EV_KEY, 38, 0), (EV_KEY, 50, 0)))
+    assert ready(listener, fd_r)
+    assert [(data.pressed, data.repeated, data.symbol, data.string, data.mods_mask)
+            for data in events] == [
+        (True, False, 'Shift_L', None, 0),
+        (True, False, 'A', 'A', 1),
+        (True, True, 'A', 'A', 1),
+        (False, False, 'A', 'A', 1),
+        (False, False, 'Shift_L', None, 1),
+    ]
+    assert listener.stats['events'] == 5 and listener.stats['batches'] == 1
+
+
+def test_dropped_events_reset_the_keyboard_state(device):
+    fd_r, fd_w = device
+    events = []
+    listener = fakes.evdev_listener(events.extend, batch=True)
+    os.write(fd_w, input_events((EV_KEY, 50, 1), (EV_SYN, SYN_DROPPED, 0), (EV_KEY, 38, 1)))
+    assert ready(listener, fd_r)
+    assert events[-1].string == 'a' and events[-1].mods_mask == 0
+    assert listener.stats['dropped'] == 1
+
+
+def test_dead_keys_are_composed(device):
+    fd_r, fd_w = device
+    events = []
+    listener = fakes.evdev_listener(events.extend, batch=True)
+    listener.composer = compose.Composer({0xfe51: {0x61: 'á'}})
+    os.write(fd_w, input_events((EV_KEY, 51, 1), (EV_KEY, 51, 0), (EV_KEY, 38, 1)))
+    assert ready(listener, fd_r)
+    assert [(data.preedit, data.filtered, data.string) for data in events] == [
+        (' \u0301', None, None),
+        (None, True, '\u0301'),
+        (None, False, '\u0301'),
+        ('', None, None),
+        (None, False, 'á'),
+    ]
+
+
+def test_backlogs_larger_than_the_queue_are_delivered(device):
+    fd_r, fd_w = device
+    events = []
+    listener = fakes.evdev_listener(events.extend, batch=True, queue_size=4)
+    # all read by a single wakeup
+    os.write(fd_w, input_events(*[(EV_KEY, 38, value) for value in [1, 0] * 10]))
+    assert ready(listener, fd_r)
+    assert [data.pressed for data in events] == [True, False] * 10
+    assert listener.queue.stats['dropped'] == 0
@@ -0,0 +1,217 @@
+import xlib
+import inputlistener
+from inputlistener import InputListener, MainLoopInputListener, GLibInputListener
+from aiolistener import AsyncInputListener
+
+from gi.repository import GLib as glib
+
+import asyncio
+import os
+import threading
+import tracemalloc
+import pytest
+
+import fakes
+
+
+def test_events_read_by_xpending_are_flushed(monkeypatch):
+    events = []
+    listener, record = fakes.record_listener(InputListener, monkeypatch, events.extend,
+                                             batch=True)
+    monkeypatch.setattr(listener, '_event_wakeup', listener._event_callback)
+
+    # the reply is read by the poll preceding select: no event is reported
+    # by Xlib, yet the keys must be delivered before blocking again
+    record.replies.append(fakes.wire(xlib.KeyPress, 38, time=1))
+    r_fd = listener._ready_fds()
+    assert r_fd == [listener.capture_fd]
+    listener._process(r_fd)
+    assert [(data.pressed, data.string) for data in events] == [(True, 'a')]
+    assert listener._ready_fds() == []
+
+
+def test_glib_watch_processes_the_record_connection(monkeypatch):
+    events = []
+    listener, record = fakes.record_listener(GLibInputListener, monkeypatch, events.extend,
+                                             batch=True)
+    # nothing buffered by Xlib: only the fd watch tells about the reply
+    monkeypatch.setattr(xlib, 'XPending', lambda dpy: 0)
+    record.replies.append(fakes.wire(xlib.KeyPress, 38, time=1) +
+                          fakes.wire(xlib.KeyRelease, 38, time=2))
+    assert listener._fd_ready(listener.capture_fd, glib.IOCondition.IN)
+    assert [(data.pressed, data.symbol) for data in events] == [(True, 'a'), (False, 'a')]
+
+
+def test_asyncio_reader_processes_the_record_connection(monkeypatch):
+    loop = asyncio.new_event_loop()
+    wake_r, wake_w = os.pipe()
+    try:
+        listener, record = fakes.record_listener(
+            lambda callback, *args, **kwargs: AsyncInputListener(loop, *args, **kwargs),
+            monkeypatch, None)
+        monkeypatch.setattr(xlib, 'XPending', lambda dpy: 0)
+
+        def read(dpy):
+            os.read(wake_r, 1)
+            return record.read(dpy)
+        monkeypatch.setattr(xlib, 'XRecordProcessReplies', read)
+        listener.capture_fd = wake_r
+        listener._watch([wake_r])
+
+        record.replies.append(fakes.wire(xlib.KeyPress, 38, time=1))
+        os.write(wake_w, b'\0')
+        loop.run_until_complete(asyncio.wait_for(listener.ready.wait(), 1))
+        listener._unwatch()
+        assert [data.string for data in listener.queue.take()] == ['a']
+    finally:
+        loop.close()
+        os.close(wake_r)
+        os.close(wake_w)
+
+
+def test_focus_changes_only_follow_the_focused_window(monkeypatch):
+    listener, _ = fakes.record_listener(InputListener, monkeypatch, None, kbd_translator='xim')
+    listener.replay_win = 1
+    listener.custom_atom = 99
+    fwd = listener._fwd_buf
+    fwd.ev.type = xlib.ClientMessage
+    fwd.xclient.message_type = listener.custom_atom
+    sent = []
+    monkeypatch.setattr(xlib, 'XSendEvent', lambda dpy, win, propagate, mask, ref:
+                        sent.append(list(fwd.xclient_data[:3])))
+    focused = []
+    monkeypatch.setattr(listener, '_kbd_focus', focused.append)
+
+    # one focus change as recorded: client, frame, pointer window and root
+    for window, detail in [(0x400010, xlib.NotifyNonlinear),
+                           (0x200001, xlib.NotifyNonlinearVirtual),
+                           (0x400020, xlib.NotifyPointer),
+                           (0x100, xlib.NotifyPointerRoot)]:
+        wev, = xlib.XWireEvents(fakes.wire(xlib.FocusIn, detail, time=window))
+        listener._event_forward(wev)
+    assert sent[0] == [xlib.FocusIn, 0x400010, xlib.NotifyNonlinear]
+
+    for data in sent:
+        fwd.xclient_data[:3] = data
+        listener._kbd_process(fwd)
+    assert focused == [0x400010]
+
+
+def failed_setup(listener, monkeypatch, closed):
+    # the replay connection is open when the capture turns out unavailable
+    def setup():
+        listener.replay_dpy = 'replay'
+        raise Exception("XInput 2.1 not available")
+    monkeypatch.setattr(listener, '_setup', setup)
+    monkeypatch.setattr(xlib, 'XCloseDisplay', closed.append)
+
+
+def test_failed_setup_releases_the_thread_lock(monkeypatch):
+    closed = []
+    listener = InputListener(None, kbd_translator='xkb')
+    failed_setup(listener, monkeypatch, closed)
+    monkeypatch.setattr(threading, 'excepthook', lambda args: None)
+    listener.start()
+    listener.join(1)
+    assert not listener.is_alive() and listener.stopped
+    assert closed == ['replay']
+
+    # must neither block nor disable a capture which never started
+    monkeypatch.setattr(listener, '_capture_disable', None)
+    stopper = threading.Thread(target=listener.stop)
+    stopper.start()
+    stopper.join(1)
+    assert not stopper.is_alive()
+
+
+def test_failed_setup_resets_main_loop_listeners(monkeypatch):
+    closed = []
+    listener = GLibInputListener(None, kbd_translator='xkb')
+    failed_setup(listener, monkeypatch, closed)
+    with pytest.raises(Exception):
+        listener.start()
+    assert listener.stopped and not listener.is_alive()
+    assert closed == ['replay'] and listener.replay_dpy is None
+    listener.stop()
+
+
+@pytest.mark.parametrize('translator', ['xkb', 'xim'])
+def test_key_path_allocations_stay_flat(translator, monkeypatch):
+    listener, record = fakes.record_listener(InputListener, monkeypatch, lambda events: None,
+                                             batch=True)
+    monkeypatch.setattr(listener, '_event_wakeup', listener._event_callback)
+    if translator == 'xim':
+        # recorded events are forwarded to the replay connection
+        listener._kbd_xkb = None
+        listener._replay_dpy_addr = 0
+        listener.replay_win = 1
+        monkeypatch.setattr(xlib, 'XWireToEvent', lambda dpy, wev, ev: True)
+        monkeypatch.setattr(xlib, 'XSendEvent', lambda dpy, win, propagate, mask, ref: 1)
+
+    reply = b''.join(fakes.wire(ev_type, keycode, time=time)
+                     for time, keycode in enumerate([38, 24, 65, 36])
+                     for ev_type in [xlib.KeyPress, xlib.KeyRelease])
+
+    def feed(count):
+        for _ in range(count):
+            listener._event_received(reply)
+            listener._event_flush()
+
+    # caches and buffers are filled on the first events
+    feed(10)
+    tracemalloc.start()
+    try:
+        feed(10)
+        base = tracemalloc.get_traced_memory()[0]
+        sizes = []
+        for _ in range(10):
+            feed(100)
+            sizes.append(tracemalloc.get_traced_memory()[0] - base)
+    finally:
+        tracemalloc.stop()
+    # 8000 events: nothing retained per event
+    assert max(sizes) < 4096
+    assert listener.stats['events'] == 8 * 1020
+
+
+def test_reconfigure_switches_translation(monkeypatch):
+    events = []
+    listener, record = fakes.record_listener(GLibInputListener, monkeypatch, events.extend,
+                                             batch=True)
+    monkeypatch.setattr(xlib, 'XPending', lambda dpy: 0)
+    shift_a = fakes.wire(xlib.KeyPress, 38, xlib.ShiftMask, time=1)
+    for options in [{}, {'kbd_translate': False}, {'kbd_levels': False}]:
+        listener.reconfigure(**options)
+        record.replies.append(shift_a)
+        listener._fd_ready(listener.capture_fd, glib.IOCondition.IN)
+    assert [(data.symbol, data.string) for data in events] == \
+        [('A', 'A'), ('A', 'A'), ('a', 'a')]
+
+    # started without translation, and hence without the xkb translator
+    listener._kbd_xkb = None
+    monkeypatch.setattr(inputlistener, 'im_active', lambda: False)
+    monkeypatch.setattr(inputlistener.xkb, 'XkbTranslator', lambda dpy: fakes.FakeTranslator())
+    listener.reconfigure(kbd_translate=True)
+    assert isinstance(listener._kbd_xkb, fakes.FakeTranslator)
+
+
+def test_focus_changes_count_the_avoided_resets(monkeypatch):
+    listener, _ = fakes.record_listener(InputListener, monkeypatch, None, kbd_translator='xim')
+    xics = iter(range(100, 200))
+    monkeypatch.setattr(listener, '_kbd_create_ic', lambda: next(xics))
+    monkeypatch.setattr(xlib, 'XSetICFocus', lambda xic: None)
+    monkeypatch.setattr(xlib, 'XUnsetICFocus', lambda xic: None)
+    listener._kbd_preedits = {}
+    listener._kbd_replay_xic = listener._kbd_xics[None] = next(xics)
+
+    for window in [1, 2, 1, 3, 2]:
+        listener._kbd_focus(window)
+    stats = listener.stats
+    assert (stats['xic_hits'], stats['xic_misses']) == (2, 3)
+    assert stats['xic_resets_avoided'] == 5
+
+
+def test_main_loop_listeners_need_a_loop():
+    with pytest.raises(TypeError):
+        MainLoopInputListener(None)
+    GLibInputListener(None)
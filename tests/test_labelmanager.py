@@ -0,0 +1,242 @@
+from array import array
+import itertools
+import logging
+import random
+import pytest
+
+import labelmanager
+from labelmanager import LabelManager
+from inputlistener import KeyData
+
+
+class PangoContext():
+    def list_families(self):
+        return []
+
+
+class Listener():
+    def __init__(self, alive=False):
+        self.alive = alive
+        self.started = False
+        self.stopped = False
+        self.backend = 'record'
+
+    def start(self):
+        self.started = True
+
+    def reconfigure(self, kbd_translate=None, kbd_levels=None):
+        self.options = (kbd_translate, kbd_levels)
+
+    def stop(self):
+        self.stopped = True
+
+    def join(self, timeout=None):
+        pass
+
+    def is_alive(self):
+        return self.alive
+
+
+class Clock():
+    # stands for time.monotonic
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def key(symbol, string=None, repeated=False):
+    return KeyData(pressed=True, filtered=False, repeated=repeated, keysym=0,
+                   symbol=symbol, string=string if string is not None else symbol,
+                   mods_mask=0)
+
+
+def label_manager(output=None, **kwargs):
+    return LabelManager(output.append if output is not None else lambda markup: None,
+                        logging.getLogger('test'), 'composed', 'baked', 'normal', False,
+                        False, False, True, 0.2, 3, [], PangoContext(), **kwargs)
+
+
+def test_restart_waits_for_a_stuck_listener(monkeypatch):
+    created = []
+    monkeypatch.setattr(labelmanager.backends, 'create',
+                        lambda *args, **kwargs: created.append(Listener()) or created[-1])
+    lm = label_manager()
+    stuck = lm.kl = Listener(alive=True)
+    assert not lm.stop()
+    lm.start()
+    assert stuck.stopped and lm.kl is stuck and not created
+
+    stuck.alive = False
+    lm.start()
+    assert lm.kl is created[0] and created[0].started
+
+
+def test_key_mode_changes_reconfigure_the_listener(monkeypatch):
+    created = []
+    monkeypatch.setattr(labelmanager.backends, 'create',
+                        lambda *args, **kwargs: created.append(Listener()) or created[-1])
+    lm = label_manager()
+    lm.start()
+    assert len(created) == 1
+
+    # composition needs new input contexts: the capture is restarted
+    lm.set_key_mode('translated')
+    assert len(created) == 2 and created[0].stopped
+    for key_mode, options in [('keysyms', (False, True)), ('raw', (False, False)),
+                              ('translated', (True, True))]:
+        lm.set_key_mode(key_mode)
+        assert lm.key_mode == key_mode and created[1].options == options
+    assert len(created) == 2 and not created[1].stopped
+    lm.set_key_mode('composed')
+    assert len(created) == 3 and created[1].stopped
+
+
+def test_held_key_stays_flat(monkeypatch):
+    clock = Clock()
+    lm = label_manager(clock=clock)
+    rendered = []
+    segment = lm._segment
+    monkeypatch.setattr(lm, '_segment', lambda i: rendered.append(i) or segment(i))
+    for symbol in 'screenkey':
+        lm.key_press(key(symbol))
+
+    # a minute of auto-repeat at 30 Hz: one entry counting the repeats, and
+    # a label which only changes by the digits of the counter
+    sizes = set()
+    lm.key_press(key('a'))
+    for count in range(2, 1802):
+        clock.now += 1 / 30
+        del rendered[:]
+        lm.key_press(key('a', repeated=True))
+        assert rendered == [len(lm.data) - 1]
+        if count > lm.compr_cnt:
+            sizes.add((len(lm.data), len(lm.markup) - len(str(count))))
+    assert lm.data[-1].count == 1801
+    assert len(sizes) == 1 and sizes.pop()[0] == 9
+
+
+def test_baked_backspace_shortens_a_run():
+    lm = label_manager()
+    lm.key_press(key('x'))
+    for _ in range(5):
+        lm.key_press(key('a', repeated=True))
+    assert [(data.markup, data.count) for data in lm.data] == [('x', 1), ('a', 5)]
+
+    lm.key_press(key('BackSpace', '\b'))
+    assert [(data.markup, data.count) for data in lm.data] == [('x', 1), ('a', 4)]
+    assert len(lm.stamps) == 2
+    for _ in range(4):
+        lm.key_press(key('BackSpace', '\b'))
+    assert [(data.markup, data.count) for data in lm.data] == [('x', 1)]
+    assert len(lm.stamps) == 1
+
+
+def test_underline_follows_the_clock():
+    clock = Clock()
+    output = []
+    lm = label_manager(output, clock=clock)
+    plain = lambda: lm.markup.replace('\u200c', '')
+
+    lm.key_press(key('a'))
+    clock.now = 0.1
+    lm.key_press(key('b'))
+    assert plain() == '<u>ab</u>'
+
+    # recent_thr is 0.2: keys older than that lose the underline
+    clock.now = 0.25
+    lm.key_press(key('c'))
+    assert plain() == 'a<u>bc</u>'
+    clock.now = 0.35
+    lm.update_text()
+    assert plain() == 'ab<u>c</u>'
+    clock.now = 0.5
+    lm.update_text()
+    assert plain() == 'abc'
+    assert output[-1] == lm.markup
+
+
+class Timeouts():
+    # GLib timeouts of the label manager, run on the fake clock
+    def __init__(self, clock, monkeypatch):
+        self.clock = clock
+        self.sources = {}
+        self.tags = itertools.count(1)
+        monkeypatch.setattr(labelmanager.GLib, 'timeout_add', self.add)
+        monkeypatch.setattr(labelmanager.GLib, 'source_remove', self.remove)
+
+    def add(self, interval, func):
+        tag = next(self.tags)
+        self.sources[tag] = (self.clock.now + interval / 1000, func)
+        return tag
+
+    def remove(self, tag):
+        return self.sources.pop(tag, None) is not None
+
+    def advance(self, delay):
+        # fire the timeouts due in order, each at its own deadline
+        end = self.clock.now + delay
+        while self.sources:
+            tag, (deadline, func) = min(self.sources.items(), key=lambda item: item[1][0])
+            if deadline > end:
+                break
+            del self.sources[tag]
+            self.clock.now = deadline
+            func()
+        self.clock.now = end
+
+
+def from_scratch(lm):
+    # the same entries rendered without any cached segment
+    ref = label_manager(clock=lm.clock)
+    ref.compr_cnt = lm.compr_cnt
+    ref.data = list(lm.data)
+    ref.stamps = array('d', lm.stamps)
+    ref.update_text()
+    return ref.markup
+
+
+KEYS = [key('a'), key('a'), key('b'), key('space', ' '), key('Return', '\r'),
+        key('BackSpace', '\b')]
+
+
+@pytest.mark.parametrize('compr_cnt', [0, 1, 3])
+def test_expiry_matches_a_full_render(compr_cnt, monkeypatch):
+    rand = random.Random(compr_cnt)
+    clock = Clock()
+    timeouts = Timeouts(clock, monkeypatch)
+    for _ in range(100):
+        lm = label_manager(clock=clock, expire=1.0)
+        lm.compr_cnt = compr_cnt
+        for _ in range(rand.randrange(40)):
+            timeouts.advance(rand.choice([0.01, 0.1, 0.3, 0.7]))
+            # timeouts have a millisecond resolution
+            assert all(stamp > clock.now - lm.expire - 0.002 for stamp in lm.stamps)
+            lm.key_press(rand.choice(KEYS))
+            assert lm.markup == from_scratch(lm)
+            assert len(timeouts.sources) <= 1
+
+        # everything expires in the end, and the timeout is not renewed
+        timeouts.advance(lm.expire + 0.002)
+        assert not lm.data and lm.markup == '' and not timeouts.sources
+
+
+def test_history_compaction_matches_a_full_render(monkeypatch):
+    monkeypatch.setattr(labelmanager, 'HISTORY_CHUNK', 4)
+    rand = random.Random(0)
+    clock = Clock()
+    lm = label_manager(clock=clock, history=10)
+    unlimited = label_manager(clock=clock, history=0)
+    for _ in range(500):
+        clock.now += rand.choice([0.01, 0.1, 0.3])
+        event = rand.choice(KEYS[:-1])
+        lm.key_press(event)
+        unlimited.key_press(event)
+
+        # only the oldest entries are dropped, and never below the history
+        assert 10 <= len(lm.data) < 10 + 4 or len(lm.data) == len(unlimited.data)
+        assert lm.data == unlimited.data[-len(lm.data):]
+        assert lm.stamps == unlimited.stamps[-len(lm.stamps):]
+        assert lm.markup == from_scratch(lm)
+    assert len(unlimited.data) > 100
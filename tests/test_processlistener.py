@@ -0,0 +1,46 @@
+import logging
+import os
+
+import processlistener
+from processlistener import EventRing, ProcessInputListener, RECORD_STRING
+from inputlistener import KeyData
+
+from gi.repository import GLib as glib
+
+
+def test_long_strings_span_continuation_records():
+    preedit = '日本語の入力を表示する' * 5
+    ring = EventRing(slots=64)
+    ring.write([KeyData(preedit=preedit),
+                KeyData(pressed=True, keysym=0x61, string='a', symbol='a'),
+                KeyData(pressed=True, string='ü' * RECORD_STRING)])
+    events = ring.read()
+    assert len(preedit.encode('utf-8')) > RECORD_STRING
+    assert [(data.preedit, data.string) for data in events] == \
+        [(preedit, None), (None, 'a'), (None, 'ü' * RECORD_STRING)]
+    assert events[1].symbol == 'a'
+
+
+def test_events_not_fitting_in_the_ring_are_dropped_whole():
+    ring = EventRing(slots=4)
+    ring.write([KeyData(string='x' * RECORD_STRING * 3), KeyData(string='y' * RECORD_STRING * 2)])
+    assert [data.string for data in ring.read()] == ['x' * RECORD_STRING * 3]
+    assert ring.dropped == 1
+
+
+def test_capture_exit_is_reported(monkeypatch, caplog):
+    monkeypatch.setattr(processlistener, 'capture_main', lambda *args: os._exit(3))
+    listener = ProcessInputListener(lambda data: None)
+    listener.start()
+    sources = [tag for tag, source in glib.sources.items()
+               if source[0] == 'fd' and source[3] == listener.process.sentinel]
+    assert len(sources) == 1
+    _, func, args, fd, condition = glib.sources[sources[0]]
+
+    listener.process.join(5)
+    with caplog.at_level(logging.ERROR):
+        assert not func(fd, glib.IOCondition.IN, *args)
+    assert 'exit code 3' in caplog.text
+    assert not listener.is_alive()
+    assert listener._source is None and listener._child_source is None
+    listener.join()
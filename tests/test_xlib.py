@@ -0,0 +1,21 @@
+import ctypes
+import importlib.util
+
+import conftest
+import xlib
+
+
+def test_libxi_is_optional(monkeypatch):
+    load = conftest._load(ctypes.CDLL)
+    def cdll(name, *args, **kwargs):
+        if name.startswith('libXi.'):
+            raise OSError(name)
+        return load(name, *args, **kwargs)
+    monkeypatch.setattr(ctypes, 'CDLL', cdll)
+
+    spec = importlib.util.spec_from_file_location('xlib_without_xi', xlib.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    assert module.libXi is None
+    assert not hasattr(module, 'XIQueryVersion')
+    assert module.XI_RawKeyPress == xlib.XI_RawKeyPress